@@ -0,0 +1,58 @@
+import argparse
+import time
+import numpy as np
+import scipy.sparse as sps
+from libfm_sparse_v2 import Data, DataMetaInfo, libFM, MCMC_learn
+
+'''
+Time of the colored sweeps of MCMC_learn for each number of threads and its
+speedup over one thread. The blocks of a color only run in parallel with
+kernels which release the GIL (-backend numba), the numpy blocks mostly hold it.
+
+python benchmark_threads.py -backend numba -threads 1,2,4,8
+'''
+
+def random_data(num_cases, num_feature, nnz, seed=0):
+    """ train set of num_cases cases with nnz random features each """
+    rng = np.random.RandomState(seed)
+    indices = rng.randint(num_feature, size=num_cases * nnz).astype(np.int32)
+    indptr = np.arange(0, num_cases * nnz + 1, nnz)
+    X = sps.csr_matrix((rng.rand(num_cases * nnz), indices, indptr), shape=(num_cases, num_feature))
+    X.sum_duplicates()
+    target = X.dot(rng.randn(num_feature)) + 0.1 * rng.randn(num_cases)
+    return Data.from_csr(target, X, False, True, role='train'), Data.from_csr(target, X[:1000], True, False, role='eval')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-num_cases", type=int, default=200000)
+    parser.add_argument("-num_feature", type=int, default=20000)
+    parser.add_argument("-nnz", type=int, default=10, help="Features per case")
+    parser.add_argument("-dim", type=str, default='1,1,8')
+    parser.add_argument("-iteration", type=int, default=5)
+    parser.add_argument("-backend", type=str, choices=['numpy', 'numba', 'python'], default='numba')
+    parser.add_argument("-threads", type=str, default='1,2,4')
+    args = parser.parse_args()
+
+    train, test = random_data(args.num_cases, args.num_feature, args.nnz)
+    train.color_classes # built once, not timed
+
+    times = {}
+    for num_threads in map(int, args.threads.split(',')):
+        fm = libFM(args.num_feature, seed=1, method='mcmc', num_iter=args.iteration, dim=args.dim)
+        mcmc = MCMC_learn(fm, DataMetaInfo(args.num_feature), train, test, 0, colored=True,
+                          num_threads=num_threads, backend=args.backend)
+        mcmc.predict_data_and_write_to_eterms()
+        mcmc.cache[0] -= train.target_value
+        mcmc.draw_all() # numba compilation
+        start = time.time()
+        for i in xrange(args.iteration):
+            mcmc.draw_all()
+        times[num_threads] = (time.time() - start) / args.iteration
+        mcmc.close()
+        print "threads=", num_threads, "\tsec/iter=", times[num_threads],
+        print "\tspeedup=", times[min(times)] / times[num_threads]
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,35 @@
 import argparse
+import bz2
+import gzip
+import json
+import multiprocessing
 import numpy as np
+import os
+import Queue
 import random
 import sys
+import threading
+import time
+import traceback
+from multiprocessing.connection import Client, Listener
+from multiprocessing.pool import ThreadPool
 import scipy.sparse as sps
 from scipy.sparse import coo_matrix
 from numpy.lib.stride_tricks import as_strided
 
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
 # Usefull only for profilage
 import cProfile
 from pstats import Stats
@@ -20,8 +44,6 @@ Rewrite in draw_v and draw_w the option of the two lines below.
 Take care for out of bounds values in each draw function
 
 Add classification possibility and not only regression
-
-Implement burn in
 '''
 
 ####################################
@@ -54,10 +76,14 @@ class libFM:
         learning method (SGD, SGDA, ALS, MCMC); default=MCMC
     seed : int
         The seed of the pseudo random number generator
+    dtype : 
+        float dtype of w, v and of the e/q caches of MCMC_learn; np.float32
+        halves their memory, the accumulations stay in float64
     """
     def __init__(self, num_attribute, learn_rate=0.01, num_iter=2, dim='1,1,2',
                 param_regular='0,0,0.1', init_stdev=0.1, task='regression', 
-                method='mcmc', verbose=True, seed=None, output_file='output.csv'):
+                method='mcmc', verbose=True, seed=None, output_file='output.csv',
+                dtype=np.float64):
         
         if method == 'mcmc':
             self.do_sample = True
@@ -76,7 +102,8 @@ class libFM:
             raise Exception('Error dimension not matching 3')
         
         
-        self.num_attribute = num_attribute
+        self.num_attribute = int(num_attribute)
+        self.dtype = np.dtype(dtype)
         self.num_iter = num_iter
         self.learn_rate = learn_rate
         self.init_stdev = init_stdev
@@ -106,9 +133,9 @@ class libFM:
         if self.k0:
             self.w0 = 0
         if self.k1:
-            self.w = np.random.normal(init_mean, init_stdev, self.num_attribute)
+            self.w = np.random.normal(init_mean, init_stdev, self.num_attribute).astype(self.dtype)
         if self.num_factor > 0:
-            self.v = np.random.normal(init_mean, init_stdev, (self.num_factor, self.num_attribute))
+            self.v = np.random.normal(init_mean, init_stdev, (self.num_factor, self.num_attribute)).astype(self.dtype)
 
         #m_sum = np.zeros(self.num_factor)
         #m_sum_sqr = np.zeros(self.num_factor)
@@ -119,10 +146,148 @@ class libFM:
 ####################################
 ####################################
 ####################################
+
+# draw_v_joint: number of floats of the per value k x k products of a chunk of features;
+# a feature with more values is drawn alone, H^T H summed over slices of its values
+JOINT_CHUNK_SIZE = 1 << 23
+# added to the diagonal of the precisions (times 1 + their largest diagonal), keeps
+# them positive definite (flat prior)
+JOINT_JITTER = 1e-10
+# a precision whose smallest squared Cholesky pivot is below JOINT_RANK_TOL (times 
+# 1 + its largest diagonal) is rank deficient (e.g. a feature in less than k cases),
+# its feature is drawn a factor at a time as in draw_v
+JOINT_RANK_TOL = 1e-8
+
+class ActiveSet:
+    """
+    Features of the ALS sweeps: a feature whose update was below tol is 
+    skipped for 1, 2, 4, ... up to max_skip sweeps. All the features are swept
+    every full_sweep iterations, which reactivates the ones which still move.
+    """
+    def __init__(self, num_feature, tol=1e-6, full_sweep=10, max_skip=8):
+        self.tol = tol
+        self.full_sweep = full_sweep
+        self.max_skip = max_skip
+        self.next_sweep = np.zeros(num_feature, dtype=np.int32)
+        self.num_skip = np.zeros(num_feature, dtype=np.int32)
+
+    def rows(self, iteration):
+        """ features to sweep at this iteration """
+        if iteration % self.full_sweep == 0:
+            return np.arange(self.next_sweep.shape[0])
+        return np.flatnonzero(self.next_sweep <= iteration)
+
+    def update(self, iteration, rows, change):
+        """ schedule the next sweep of the features rows from the change of their value """
+        small = np.abs(change) < self.tol
+        self.num_skip[rows] = np.where(small, np.clip(2 * self.num_skip[rows], 1, self.max_skip), 0)
+        self.next_sweep[rows] = iteration + 1 + self.num_skip[rows]
+
+class RunningMean:
+    """
+    Online mean (and variance if variance) of the samples of a vector of size n,
+    updated in place (Welford) without allocating. 
+    """
+    def __init__(self, n, variance=False):
+        self.num_samples = 0
+        self.mean = np.zeros(n, dtype=np.float64)
+        self.delta = np.zeros(n, dtype=np.float64)
+        self.m2 = np.zeros(n, dtype=np.float64) if variance else None
+        self.buf = np.zeros(n, dtype=np.float64) if variance else None
+
+    def add(self, x):
+        self.num_samples += 1
+        np.subtract(x, self.mean, out=self.delta)
+        self.delta /= self.num_samples
+        self.mean += self.delta
+        if self.m2 is not None:
+            # m2 += (x - mean_old) * (x - mean_new) = n * delta * (x - mean_new)
+            self.delta *= self.num_samples
+            np.subtract(x, self.mean, out=self.buf)
+            self.buf *= self.delta
+            self.m2 += self.buf
+
+    def var(self):
+        """ variance of the samples """
+        return self.m2 / max(self.num_samples, 1)
+
+
+def predict_fm(fm, data):
+    """ 
+    Prediction of the cases of data, with a single product X V^T for all
+    the factors: w0 + X w + 1/2 sum_f ((X v_f)^2 - X^2 v_f^2)
+    """
+    pred = np.zeros(data.num_cases)
+    if fm.k0:
+        pred += fm.w0
+    if fm.k1:
+        pred += data.dot_t(fm.w)
+    if fm.num_factor > 0:
+        q = data.dot_t(fm.v) # num_factor x num_cases
+        pred += 0.5 * np.sum(q * q, axis=0)
+        pred -= 0.5 * data.dot_t_sqr(np.sum(fm.v * fm.v, axis=0))
+    return pred
    
 class MCMC_learn:
 
-    def __init__(self, fm, meta, train, test, burn):
+    """
+    colored : draw the w and v of each color of train.color_classes (features 
+              which never share a case) together instead of one feature at a time
+    num_threads : draw the features of a color in num_threads blocks in parallel 
+                  (implies colored). The results do not depend on num_threads.
+                  The blocks only run concurrently with kernels which release
+                  the GIL (backend='numba'), see benchmark_threads.py.
+                  learn stops the threads at its end, call close() after draw_all.
+    q_cache : keep the q(f)-terms of the train cases (num_factor x num_cases) 
+              up to date instead of recomputing them for each factor
+    q_cache_limit : memory (bytes) of the q cache, the factors beyond it are
+                    recomputed; default=None (no limit)
+    resync : recompute the train e-terms every resync iterations (they are
+             updated by the draws, this only limits the floating point drift);
+             default=0 (never)
+    joint : draw the k factors of each feature together from their joint
+            conditional (block Gibbs / block ALS), a color of train.color_classes
+            at a time, instead of one factor after the other
+    
+    backend : kernels of the per-feature loops of the sequential and colored 
+              draw_w/draw_v (not jacobi nor joint), see get_kernels; default='numpy'
+    jacobi : ALS only, update all the features of a sweep at once from the same
+             e-terms (Jacobi), damped by damping. A sweep which increases the 
+             loss is undone and done one feature after the other.
+    active_set : ALS only, skip the features which do not move anymore in the
+                 sequential and colored sweeps, see ActiveSet (active_tol, full_sweep)
+    
+    burn : MCMC only, the first burn samples are not predicted nor averaged
+    thin : MCMC only, predict and average one sample every thin after the burn-in;
+           default=1
+    pred_var : MCMC only, keep the variance of the predictions of the samples 
+               (posterior.var())
+    keep_samples : MCMC only, append the (w0, w, v) of the kept samples to samples
+    
+    eval_every : print the train and test errors every eval_every iterations
+                 (and after the last one), 0 for the last one only; default=1
+    eval_sample : compute these errors on eval_sample random train and test 
+                  cases (the same at each evaluation); default=None (all)
+    tol, patience : stop when the relative change of the RMSE stayed below tol
+                    for patience evaluations, see converged; default=0 (never)
+    time_budget : stop after the iteration which exceeds time_budget seconds;
+                  default=None (no limit)
+    stream : key added to the seed in the random streams of the draws, e.g. the
+             shard of a consensus chain: the same initial model (fm.seed) with 
+             independent draws; default=()
+    fm.num_iter is the maximum number of iterations, num_iter_done and 
+    stop_reason tell how learn ended.
+    
+    The draws do not use the global np.random state: each sweep of an iteration
+    draws its normals at once from its own stream, keyed by (seed, stream, 
+    iteration, sweep), see substream. They do not depend on how the sweep is split.
+    """
+
+    def __init__(self, fm, meta, train, test, burn, colored=False, num_threads=1,
+                 q_cache=False, q_cache_limit=None, resync=0, joint=False, backend='numpy',
+                 jacobi=False, damping=0.5, active_set=False, active_tol=1e-6, full_sweep=10,
+                 thin=1, pred_var=False, eval_every=1, eval_sample=None, tol=0.0, patience=1,
+                 time_budget=None, keep_samples=False, stream=()):
         self.fm = fm
         self.meta = meta
         self.num_iter = fm.num_iter
@@ -134,8 +299,6 @@ class MCMC_learn:
         self.train = train
         self.test = test
         
-        self.cache_for_group_values = np.zeros(meta.num_attr_groups)
-
         self.alpha_0, self.gamma_0, self.beta_0, self.mu_0  = 1.0, 1.0, 1.0, 0.0 
         self.alpha = 1.0
         
@@ -147,13 +310,67 @@ class MCMC_learn:
         self.v_mu = np.zeros((meta.num_attr_groups, fm.num_factor), dtype=float)
         self.v_lambda = fm.regv * np.ones((meta.num_attr_groups, fm.num_factor), dtype=float) 
         
-        self.pred_sum_all = np.zeros(test.num_cases, dtype=float) 
+        self.posterior = RunningMean(test.num_cases, pred_var)
         self.pred_this = np.zeros(test.num_cases, dtype=float) 
 
-        self.cache  = np.zeros((2, train.num_cases),dtype=float) #e_q_term 
-        self.cache_test = np.zeros((2, test.num_cases), dtype=float) #e_q_term 
+        self.cache  = np.zeros((2, train.num_cases),dtype=fm.dtype) #e_q_term 
+        self.cache_test = np.zeros((2, test.num_cases), dtype=fm.dtype) #e_q_term 
         
         self.burn = burn
+        self.thin = thin
+        self.samples = [] if keep_samples else None
+        self.colored = colored or num_threads > 1
+        self.num_threads = num_threads
+        self.pool = None # ThreadPool of num_threads, started by the first colored sweep
+        
+        self.num_q_cached = fm.num_factor if q_cache else 0
+        if q_cache_limit is not None:
+            self.num_q_cached = min(self.num_q_cached, int(q_cache_limit // (fm.dtype.itemsize * max(train.num_cases, 1))))
+        self.q = None
+        self.resync = resync
+        self.joint = joint
+        self.kernels = get_kernels('numpy' if backend == 'auto' and (jacobi or joint) else backend)
+        if self.kernels is not None and (jacobi or joint):
+            raise Exception('The Jacobi and joint draws have no kernel, use backend=numpy')
+        if jacobi and fm.do_sample:
+            raise Exception('The Jacobi updates are for ALS')
+        self.jacobi = jacobi
+        self.damping = damping
+        self.num_jacobi_fallbacks = 0
+        self.t_seg = None
+        
+        self.w_active, self.v_active = None, [None] * fm.num_factor
+        if active_set:
+            if fm.do_sample or jacobi or joint:
+                raise Exception('The active set is for the sequential and colored ALS sweeps')
+            self.w_active = ActiveSet(train.t_rows, active_tol, full_sweep)
+            self.v_active = [ActiveSet(train.t_rows, active_tol, full_sweep) for f in xrange(fm.num_factor)]
+        
+        self.seed = fm.seed if fm.seed is not None and fm.seed > -1 else np.random.randint(1 << 31)
+        self.stream = list(stream)
+        self.iteration = 0
+        self.random = self.substream(0)
+        
+        self.eval_every = eval_every
+        self.history = []
+        self.tol = tol
+        self.patience = patience
+        self.time_budget = time_budget
+        self.num_iter_done = 0
+        self.stop_reason = None
+        self.eval_rows = [self.sample_rows(train.num_cases, eval_sample, 0),
+                          self.sample_rows(test.num_cases, eval_sample, 1)]
+        self.eval_target = [data.target_value if rows is None else data.target_value[rows]
+                            for data, rows in zip([train, test], self.eval_rows)]
+        self.eval_buf = [np.zeros(target.shape[0], dtype=dtype) 
+                         for target, dtype in zip(self.eval_target, [fm.dtype, np.float64])]
+        
+    def sample_rows(self, num_cases, size, key):
+        """ sorted random subset of size of the num_cases rows, None for all """
+        if size is None or size >= num_cases:
+            return None
+        random = np.random.RandomState([self.seed, key])
+        return np.sort(random.choice(num_cases, size, replace=False))
         
     def learn(self):
 
@@ -166,38 +383,51 @@ class MCMC_learn:
         else:
             raise Exception("Unknown task")
         
-        for i in xrange(self.num_iter):
-            self.draw_all()
-            self.predict_data_and_write_to_eterms()
-
-            acc_train = 0.0
-            rmse_train = 0.0
-            if self.fm.task == 'regression':
-                # evaluate test and store it
-                tmp = np.copy(self.cache_test[0])
-                self.pred_this = np.copy(tmp)
-                tmp = np.clip(tmp, self.min_target, self.max_target)
-                self.pred_sum_all += tmp
-                
-                # Evaluate the training dataset and update the e-terms 
-                tmp = np.copy(self.cache[0])
-                tmp = np.clip(tmp, self.min_target, self.max_target)
-                err = tmp - self.train.target_value
-                rmse_train = np.sum(err*err)
-                self.cache[0] -= self.train.target_value
-                rmse_train = np.sqrt(rmse_train/self.train.num_cases)
-            elif self.fm.task == 'classification':
-                continue
-            else:
-                raise Exception('Unknown task')
-            #Evaluate the test data set
-            if self.fm.task == 'regression':
-                #rmse_test_this, mae_test_this = self.evaluate(self.pred_this, self.test.target_value, 1.0, 0, self.num_eval_cases)
-                rmse_test_all, mae_test_all = self.evaluate(self.pred_sum_all, self.test.target_value, 1.0/(i+1), 0, self.num_eval_cases)
-                print "#Iter=", i, "\tTrain=", rmse_train, "\tTest=", rmse_test_all
+        start = time.time()
+        self.stop_reason = None
+        try:
+            for i in xrange(self.num_iter):
+                self.draw_all()
+            
+                # the train e-terms are kept up to date by the draws
+                if self.resync and (i + 1) % self.resync == 0:
+                    self.q = None
+                    self.predict_data_and_write_to_eterms()
+                    self.cache[0] -= self.train.target_value
+                if self.time_budget is not None and time.time() - start > self.time_budget:
+                    self.stop_reason = 'time_budget'
+                evaluate = (i == self.num_iter - 1 or self.stop_reason is not None 
+                            or (self.eval_every and (i + 1) % self.eval_every == 0))
+                # ALS predicts when evaluating, MCMC only the kept samples
+                if self.fm.do_sample:
+                    keep = i >= self.burn and (i - self.burn) % self.thin == 0
+                else:
+                    keep = evaluate
 
-            else:
-                raise Exception('Unknown task')
+                if self.fm.task == 'regression':
+                    # evaluate test and store it
+                    if keep:
+                        self.cache_test[0] = self.predict_test()
+                        np.clip(self.cache_test[0], self.min_target, self.max_target, out=self.pred_this)
+                        if self.fm.do_sample:
+                            self.posterior.add(self.pred_this)
+                    if keep and self.fm.do_sample and self.samples is not None:
+                        self.samples.append((float(self.fm.w0) if self.fm.k0 else 0.0,
+                                             np.copy(self.fm.w) if self.fm.k1 else None,
+                                             np.copy(self.fm.v) if self.fm.num_factor > 0 else None))
+                else:
+                    raise Exception('Unknown task')
+            
+                if evaluate:
+                    self.evaluate_iteration(i)
+                    if self.stop_reason is None and self.converged():
+                        self.stop_reason = 'converged'
+                self.num_iter_done = i + 1
+                if self.stop_reason is not None:
+                    print "#Stop after", self.num_iter_done, "iterations:", self.stop_reason
+                    break
+        finally:
+            self.close() # the threads of the pool
         
         if self.fm.k0:
             print 'w0:', self.fm.w0
@@ -214,8 +444,10 @@ class MCMC_learn:
     def predict(self): 
 
         if self.fm.do_sample:
-            assert(self.test.num_cases == self.pred_sum_all.shape[0])
-            out = self.pred_sum_all / self.num_iter
+            assert(self.test.num_cases == self.posterior.mean.shape[0])
+            if not self.posterior.num_samples:
+                raise Exception('No sample kept, burn >= number of iterations')
+            out = np.copy(self.posterior.mean)
         else:
             assert(self.test.num_cases == self.pred_this.shape[0])
             out = np.copy(self.pred_this)
@@ -234,48 +466,107 @@ class MCMC_learn:
     def predict_data_and_write_to_eterms(self): #Ok
 
         self.cache.fill(0)
-        self.cache_test.fill(0)
         
         # (1) do the 1/2 sum_f (sum_i v_if x_i)^2 and store it in the e/y-term
         for f in xrange(self.fm.num_factor):
             v = self.fm.v[f] 
         
             # calculate cache[i].q = sum_i v_if x_i (== q_f-term)
-            # Complexity: O(N_z(X^M))
-            self.cache[1] += v * self.train.data_t
-            self.cache_test[1] += v * self.test.data_t
+            # Complexity: O(N_z(X^M)), O(n) with the q cache
+            self.cache[1] += self.get_q(f)
       
             # add 0.5*q^2 to e and set q to zero.
             # O(n*|B|)
             self.cache[0] += 0.5 * self.cache[1] * self.cache[1]
             self.cache[1].fill(0)
-            self.cache_test[0] += 0.5 * self.cache_test[1] * self.cache_test[1]
-            self.cache_test[1].fill(0)
         
         # (2) do -1/2 sum_f (sum_i v_if^2 x_i^2) and store it in the q-term    
-        for f in xrange(self.fm.num_factor):
-            v = self.fm.v[f]
-
-            # sum up the q^S_f terms in the main-q-cache: 0.5*sum_i (v_if x_i)^2 (== q^S_f-term)
-            # Complexity: O(N_z(X^M))
-            self.cache[1] -= 0.5 * (v * v) * self.train.tmp
-            self.cache_test[1] -= 0.5 * (v * v) * self.test.tmp
+        # == -1/2 sum_i (sum_f v_if^2) x_i^2, a single product for all the factors
+        # Complexity: O(N_z(X^M))
+        if self.fm.num_factor > 0:
+            v_sqr = np.sum(self.fm.v * self.fm.v, axis=0)
+            self.cache[1] -= 0.5 * self.train.dot_t_sqr(v_sqr)
 
         # (3) add the w's to the q-term    
         if self.fm.k1:
-            self.cache[1] += self.fm.w * self.train.data_t
-            self.cache_test[1] += self.fm.w * self.test.data_t
+            self.cache[1] += self.train.dot_t(self.fm.w)
 
         # (3) merge both for getting the prediction: w0+e(c)+q(c)
       
         self.cache[0] += self.cache[1]
-        self.cache_test[0] += self.cache_test[1]
         if self.fm.k0:
             self.cache[0] += self.fm.w0
-            self.cache_test[0] += self.fm.w0
         self.cache[1].fill(0)
-        self.cache_test[1].fill(0)
        
+    def predict_test(self):
+        """ Prediction of the test cases, see predict_fm """
+        return predict_fm(self.fm, self.test)
+
+    def get_q(self, f=None):
+        """ 
+        q(f)-term of each train case (of all the factors for f=None, 
+        num_factor x num_cases), from the q cache or recomputed 
+        """
+        if self.q is None and self.num_q_cached:
+            self.q = np.empty((self.num_q_cached, self.train.num_cases), dtype=self.fm.dtype)
+            for f_q in xrange(self.num_q_cached):
+                self.q[f_q] = self.train.dot_t(self.fm.v[f_q])
+        if f is None:
+            if self.num_q_cached == self.fm.num_factor:
+                return self.q
+            return self.train.dot_t(self.fm.v)
+        if f >= self.num_q_cached:
+            return self.train.dot_t(self.fm.v[f])
+        return self.q[f]
+
+    def evaluate_iteration(self, i):
+        """
+        Train RMSE from the e-terms and test RMSE/MAE of the posterior mean (if
+        a sample was kept, of the current prediction for ALS) on the evaluation
+        rows, appended to history.
+        """
+        train_target, test_target = self.eval_target
+        rmse_train, _ = self.metrics(self.cache[0], train_target, self.eval_rows[0], self.eval_buf[0], True)
+        if self.fm.do_sample and not self.posterior.num_samples:
+            self.history.append((i, rmse_train, np.nan, np.nan))
+            print "#Iter=", i, "\tTrain=", rmse_train
+            return
+        pred = self.posterior.mean if self.fm.do_sample else self.pred_this
+        rmse_test, mae_test = self.metrics(pred, test_target, self.eval_rows[1], self.eval_buf[1])
+        self.history.append((i, rmse_train, rmse_test, mae_test))
+        print "#Iter=", i, "\tTrain=", rmse_train, "\tTest=", rmse_test
+
+    def converged(self):
+        """
+        True if the relative change of the monitored RMSE (test, train until a
+        sample is kept) stayed below tol over the last patience evaluations.
+        """
+        if self.tol <= 0 or len(self.history) <= self.patience:
+            return False
+        column = 1 if np.isnan(self.history[-1][2]) else 2
+        rmse = np.array([h[column] for h in self.history[-self.patience - 1:]])
+        change = np.abs(np.diff(rmse)) / np.maximum(np.abs(rmse[:-1]), 1e-300)
+        # a nan (no test RMSE yet) is never below tol
+        return bool((change < self.tol).all())
+
+    def metrics(self, pred, target, rows, buf, eterms=False):
+        """
+        RMSE and MAE of the clipped pred[rows] (pred + target if eterms) 
+        against target (already restricted to rows), computed in buf.
+        """
+        if rows is None:
+            buf[:] = pred
+        else:
+            np.take(pred, rows, out=buf)
+        if eterms:
+            buf += target
+        np.clip(buf, self.min_target, self.max_target, out=buf)
+        buf -= target
+        num_cases = max(buf.shape[0], 1)
+        rmse = np.sqrt(np.dot(buf, buf) / num_cases)
+        mae = np.sum(np.absolute(buf, out=buf)) / num_cases
+        return rmse, mae
+    
     def evaluate(self, pred, target, normalizer, from_case, to_case):
         assert(pred.shape[0] == target.shape[0])
         _rmse, _mae = 0, 0
@@ -297,6 +588,8 @@ class MCMC_learn:
         
     def draw_all(self):
         
+        # the hyperparameters, w0 and the hyperpriors are drawn from the stream (iteration, 0)
+        self.random = self.substream(0)
         self.draw_alpha()
         if self.fm.k0 :
             self.draw_w0()
@@ -307,26 +600,68 @@ class MCMC_learn:
 
             # draw the w from their posterior
             g = self.meta.attr_group
-            self.draw_w(self.w_mu[g], self.w_lambda[g])
+            noise = self.sweep_noise(self.fm.num_attribute, 1)
+            rows = None if self.w_active is None else self.w_active.rows(self.iteration)
+            w_old = None if rows is None else self.fm.w[rows]
+            if self.jacobi:
+                self.draw_w_jacobi(self.w_mu[g], self.w_lambda[g])
+            elif self.colored:
+                self.draw_w_colored(self.w_mu[g], self.w_lambda[g], noise, rows)
+            else:
+                self.draw_w(self.w_mu[g], self.w_lambda[g], noise, rows)
+            if rows is not None:
+                self.w_active.update(self.iteration, rows, self.fm.w[rows] - w_old)
+            for block, index, offset in self.train.iter_relations():
+                self.draw_w_rel(block, index, offset, noise)
         
         if self.fm.num_factor > 0:
             self.draw_v_lambda()
             self.draw_v_mu()
+        
+        if self.joint and self.fm.num_factor > 0:
+            q = self.get_q()
+            noise = self.sweep_noise((self.fm.num_factor, self.fm.num_attribute), 2)
+            self.draw_colors(lambda rows, noise: self.draw_v_joint(rows, noise, q), noise)
+            for f in xrange(self.fm.num_factor):
+                self.cache[1] = q[f]
+                for block, index, offset in self.train.iter_relations():
+                    self.draw_v_rel(f, block, index, offset, None if noise is None else noise[f])
+                q[f] = self.cache[1]
+            if self.q is not None and self.q is not q:
+                self.q[:] = q[:self.num_q_cached]
+            self.iteration += 1
+            return
             
         for f in xrange(self.fm.num_factor):
 
             # add the q(f)-terms to the main relation q-cache (using only the transpose data)
-            self.cache[1] = self.fm.v[f]  * self.train.data_t
+            self.cache[1] = self.get_q(f)
             
             # draw the thetas from their posterior
             g = self.meta.attr_group
-            self.draw_v(f, self.v_mu[g,f], self.v_lambda[g,f])
+            noise = self.sweep_noise(self.fm.num_attribute, 2, f)
+            rows = None if self.v_active[f] is None else self.v_active[f].rows(self.iteration)
+            v_old = None if rows is None else self.fm.v[f, rows]
+            if self.jacobi:
+                self.draw_v_jacobi(f, self.v_mu[g,f], self.v_lambda[g,f])
+            elif self.colored:
+                self.draw_v_colored(f, self.v_mu[g,f], self.v_lambda[g,f], noise, rows)
+            else:
+                self.draw_v(f, self.v_mu[g,f], self.v_lambda[g,f], noise, rows)
+            if rows is not None:
+                self.v_active[f].update(self.iteration, rows, self.fm.v[f, rows] - v_old)
+            for block, index, offset in self.train.iter_relations():
+                self.draw_v_rel(f, block, index, offset, noise)
+            if f < self.num_q_cached:
+                self.q[f] = self.cache[1]
+        
+        self.iteration += 1
             
     # Find the optimal value for the global bias (0-way interaction)
     def draw_w0(self): #ok
         
         assert(self.train.num_cases == self.cache[0].shape[0])
-        w0_mean = np.sum(self.cache[0] - self.fm.w0) 
+        w0_mean = np.sum(self.cache[0] - self.fm.w0, dtype=np.float64) 
         w0_sigma_sqr = 1.0 / (self.fm.reg0 + self.alpha * self.train.num_cases)
         w0_mean = - w0_sigma_sqr * (self.alpha * w0_mean - self.w0_mean_0 * self.fm.reg0)
         
@@ -342,13 +677,22 @@ class MCMC_learn:
         self.cache[0] -= (w0_old - self.fm.w0)
     
     # Find the optimal value for the 1-way interaction w
-    def draw_w(self, w_mu, w_lambda):
+    def draw_w(self, w_mu, w_lambda, noise=None, rows=None):
     
         X = self.train.data_t
+        if self.kernels is not None:
+            rows = np.arange(self.train.t_rows) if rows is None else rows
+            self.kernels['draw_w'](X.indptr, X.indices, X.data, rows, self.train.x_rows_sqr, self.fm.w, self.cache[0],
+                                   np.zeros(0) if noise is None else noise[rows], self.fm.do_sample)
+            return
+
         x_rows_sqr = self.train.x_rows_sqr
-        rows, cols = self.train.t_rows, self.train.t_cols
+        row_start_stop = self.train.row_start_stop
+        if rows is None:
+            rows = xrange(self.train.t_rows)
                                     
-        for row, (start, stop) in enumerate(self.train.row_start_stop):
+        for row in rows:
+            start, stop = row_start_stop[row]
             data = X.data[start:stop]
             cols = X.indices[start:stop]
             delta = np.dot(data, self.cache[0, cols]) / x_rows_sqr[row]
@@ -360,9 +704,8 @@ class MCMC_learn:
             else:
                 if self.fm.do_sample : 
                     w_sigma_sqr = 1.0 / x_rows_sqr[row]
-                    self.fm.w[row] -= self.ran_gaussian(delta, np.sqrt(w_sigma_sqr))
-                else:
-                    self.fm.w[row] -= delta
+                    delta = delta + np.sqrt(w_sigma_sqr) * noise[row]
+                self.fm.w[row] -= delta
                     
             self.cache[0, cols] -= delta * data
             
@@ -403,12 +746,21 @@ class MCMC_learn:
     
     # Find the optimal value for the 2-way interaction parameter v
     #@profile
-    def draw_v(self, f, v_mu, v_lambda): 
+    def draw_v(self, f, v_mu, v_lambda, noise=None, rows=None): 
     
         X = self.train.data_t
-        rows, cols = self.train.t_rows, self.train.t_cols
+        if self.kernels is not None:
+            rows = np.arange(self.train.t_rows) if rows is None else rows
+            self.kernels['draw_v'](X.indptr, X.indices, X.data, rows, self.fm.v[f], self.cache[1], 
+                                   self.cache[0], np.zeros(0) if noise is None else noise[rows], self.fm.do_sample)
+            return
+
+        row_start_stop = self.train.row_start_stop
+        if rows is None:
+            rows = xrange(self.train.t_rows)
                                     
-        for row, (start, stop) in enumerate(self.train.row_start_stop):
+        for row in rows:
+            start, stop = row_start_stop[row]
             #if not row%1000:
             #    print 'v', row
             data = X.data[start:stop]
@@ -417,6 +769,8 @@ class MCMC_learn:
             Y = self.cache[1,cols] - self.fm.v[f][row] * data 
             h = data * Y
             v_sigma_sqr = np.dot(h,h)
+            if v_sigma_sqr == 0:
+                continue # the feature is alone in all its cases
             
             #v_mean = (- np.dot(h, cache[0,cols]) + v_f[row] * v_sigma_sqr) / v_sigma_sqr; v_f[row] = v_mean
             #v_mean = - np.dot(h, cache[0,cols]) / v_sigma_sqr + v_f[row] ; v_f[row] = v_mean
@@ -429,13 +783,370 @@ class MCMC_learn:
                 self.fm.v[f][row] = 0
             else:
                 if self.fm.do_sample : 
-                    self.fm.v[f][row] -= self.ran_gaussian(delta, np.sqrt(v_sigma_sqr))
-                else:
-                    self.fm.v[f][row] -= delta
+                    delta = delta + np.sqrt(1.0 / v_sigma_sqr) * noise[row]
+                self.fm.v[f][row] -= delta
             
             self.cache[1, cols] -= delta * data
             self.cache[0, cols] -= delta * h
         
+    # Same as draw_w, with one segment reduction over the values of all the
+    # features of a color: they never share a case, so their updates are the
+    # ones of the features drawn one after the other
+    def draw_w_colored(self, w_mu, w_lambda, noise=None, rows=None):
+        self.draw_colors(self.draw_w_block, noise, rows)
+    
+    # Same as draw_v, a color at a time (see draw_w_colored)
+    def draw_v_colored(self, f, v_mu, v_lambda, noise=None, rows=None): 
+        self.draw_colors(lambda rows, noise: self.draw_v_block(f, rows, noise), noise, rows)
+    
+    def draw_colors(self, draw_block, noise, active_rows=None):
+        """
+        Call draw_block(rows, noise[..., rows]) for the features of each color
+        (only the active_rows ones if set), split in num_threads blocks which 
+        are drawn in parallel. noise is the standard normals of the sweep (None
+        for ALS), one per feature (last axis).
+        """
+        order, color_ptr = self.train.color_classes
+        if active_rows is not None:
+            active = np.zeros(self.train.data_t.shape[0], dtype=np.bool_)
+            active[active_rows] = True
+        
+        for color in xrange(color_ptr.shape[0] - 1):
+            rows = order[color_ptr[color]:color_ptr[color + 1]]
+            if active_rows is not None:
+                rows = rows[active[rows]]
+                if not rows.shape[0]:
+                    continue
+            if self.num_threads == 1 or rows.shape[0] < self.num_threads:
+                draw_block(rows, None if noise is None else noise[..., rows])
+                continue
+            blocks = np.array_split(rows, self.num_threads)
+            if self.pool is None:
+                self.pool = ThreadPool(self.num_threads)
+            self.pool.map(lambda rows: draw_block(rows, None if noise is None else noise[..., rows]), blocks)
+    
+    def close(self):
+        """ Stop the threads of the pool, called at the end of learn (a later sweep starts a new pool) """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+    
+    def draw_w_block(self, rows, noise):
+    
+        X = self.train.data_t
+        x_rows_sqr = self.train.x_rows_sqr
+        if self.kernels is not None:
+            # the features of a block never share a case: the kernels of the 
+            # blocks run in parallel (without the GIL for numba)
+            self.kernels['draw_w'](X.indptr, X.indices, X.data, rows, x_rows_sqr, self.fm.w, self.cache[0],
+                                   np.zeros(0) if noise is None else noise, self.fm.do_sample)
+            return
+        
+        pos, seg = get_segments(X, rows)
+        data = X.data[pos]
+        cols = X.indices[pos]
+        delta = np.bincount(seg, weights=data * self.cache[0, cols], minlength=rows.shape[0]) / x_rows_sqr[rows]
+        
+        if self.fm.do_sample : 
+            w_sigma_sqr = 1.0 / x_rows_sqr[rows]
+            delta = delta + np.sqrt(w_sigma_sqr) * noise
+        w = self.fm.w[rows] - delta
+        self.fm.w[rows] = np.where(np.isfinite(self.fm.w[rows]), w, 0)
+                
+        self.cache[0, cols] -= delta[seg] * data
+    
+    def draw_v_block(self, f, rows, noise):
+    
+        X = self.train.data_t
+        if self.kernels is not None:
+            self.kernels['draw_v'](X.indptr, X.indices, X.data, rows, self.fm.v[f], self.cache[1], 
+                                   self.cache[0], np.zeros(0) if noise is None else noise, self.fm.do_sample)
+            return
+        
+        pos, seg = get_segments(X, rows)
+        data = X.data[pos]
+        cols = X.indices[pos]
+        
+        Y = self.cache[1, cols] - self.fm.v[f, rows][seg] * data 
+        h = data * Y
+        v_sigma_sqr = np.bincount(seg, weights=h * h, minlength=rows.shape[0])
+        alone = v_sigma_sqr == 0 # the feature is alone in all its cases
+        v_sigma_sqr[alone] = 1
+        delta = np.bincount(seg, weights=h * self.cache[0, cols], minlength=rows.shape[0]) / v_sigma_sqr
+        delta[alone] = 0
+        
+        if self.fm.do_sample : 
+            delta = np.where(alone, 0, delta + np.sqrt(1.0 / v_sigma_sqr) * noise)
+        v = self.fm.v[f, rows] - delta
+        self.fm.v[f, rows] = np.where(np.isfinite(self.fm.v[f, rows]), v, 0)
+        
+        self.cache[1, cols] -= delta[seg] * data
+        self.cache[0, cols] -= delta[seg] * h
+    
+    # Jacobi ALS: the updates of draw_w for all the features at once from the
+    # same e-terms, with segment reductions over all the values of data_t
+    def draw_w_jacobi(self, w_mu, w_lambda):
+    
+        X = self.train.data_t
+        seg = self.get_t_seg()
+        x_rows_sqr = self.train.x_rows_sqr
+        e = self.cache[0]
+        w = self.fm.w[:X.shape[0]]
+        w_old, e_old = np.copy(w), np.copy(e)
+        loss = np.sum(e * e, dtype=np.float64)
+        
+        delta = np.bincount(seg, weights=X.data * e[X.indices], minlength=X.shape[0])
+        delta[:x_rows_sqr.shape[0]] /= x_rows_sqr
+        delta *= self.damping
+        w -= delta
+        e -= np.bincount(X.indices, weights=X.data * delta[seg], minlength=e.shape[0])
+        
+        if np.sum(e * e, dtype=np.float64) > loss:
+            w[:], e[:] = w_old, e_old
+            self.num_jacobi_fallbacks += 1
+            self.draw_w(w_mu, w_lambda)
+    
+    # Same as draw_v (see draw_w_jacobi). The q-terms change with all the
+    # features at once, so the e-terms are updated with the new q-terms
+    def draw_v_jacobi(self, f, v_mu, v_lambda):
+    
+        X = self.train.data_t
+        seg = self.get_t_seg()
+        e, q = self.cache[0], self.cache[1]
+        v = self.fm.v[f, :X.shape[0]]
+        v_old, e_old, q_old = np.copy(v), np.copy(e), np.copy(q)
+        loss = np.sum(e * e, dtype=np.float64)
+        
+        data = X.data
+        cols = X.indices
+        h = data * (q[cols] - v[seg] * data)
+        v_sigma_sqr = np.bincount(seg, weights=h * h, minlength=X.shape[0])
+        alone = v_sigma_sqr == 0 # the feature is alone in all its cases
+        v_sigma_sqr[alone] = 1
+        delta = np.bincount(seg, weights=h * e[cols], minlength=X.shape[0]) / v_sigma_sqr
+        delta[alone] = 0
+        delta *= self.damping
+        v -= delta
+        
+        # e(c) += 1/2 (q_new(c)^2 - q(c)^2) - 1/2 sum_i (v_new_i^2 - v_i^2) x_ci^2
+        q -= np.bincount(cols, weights=data * delta[seg], minlength=q.shape[0])
+        e += 0.5 * (q * q - q_old * q_old)
+        e -= 0.5 * np.bincount(cols, weights=data * data * (v * v - v_old * v_old)[seg], minlength=e.shape[0])
+        
+        if np.sum(e * e, dtype=np.float64) > loss:
+            v[:], e[:], q[:] = v_old, e_old, q_old
+            self.num_jacobi_fallbacks += 1
+            self.draw_v(f, v_mu, v_lambda)
+    
+    def get_t_seg(self):
+        """ feature (row of data_t) of each train value, built once """
+        if self.t_seg is None:
+            X = self.train.data_t
+            self.t_seg = np.repeat(np.arange(X.shape[0], dtype=X.indices.dtype), np.diff(X.indptr))
+        return self.t_seg
+    
+    # The prediction of a case is linear in the k-vector v_i of a feature:
+    # y(c) = b(c) + h(c).v_i with h_f(c) = x_ci (q_f(c) - v_if x_ci). Its conditional
+    # is N(v_i - delta, A^-1) with the precision A = H H^T and A delta = H e, 
+    # drawn with the Cholesky factor of A. As in draw_v, the prior and alpha are
+    # not used: for k = 1 it is the draw of draw_v. Without a prior A is singular 
+    # for the features in less than k cases, these are drawn by draw_v_factors.
+    def draw_v_joint(self, rows, noise, q):
+    
+        X = self.train.data_t
+        k = self.fm.num_factor
+        diag = np.arange(k)
+        
+        # the features with more values than a chunk are drawn alone, the others 
+        # in chunks of at most 2 JOINT_CHUNK_SIZE floats of k x k products
+        lengths = X.indptr[rows + 1] - X.indptr[rows]
+        max_values = max(JOINT_CHUNK_SIZE // (k * k), 1)
+        for i in np.flatnonzero(lengths > max_values):
+            self.draw_v_joint_feature(rows[i], None if noise is None else noise[:, i], q)
+        small = np.flatnonzero(lengths <= max_values)
+        chunk_id = (np.cumsum(lengths[small]) - 1) // max_values
+        for chunk in np.split(small, np.flatnonzero(np.diff(chunk_id)) + 1):
+            if not chunk.shape[0]:
+                continue
+            rows_chunk = rows[chunk]
+            pos, seg = get_segments(X, rows_chunk)
+            data = X.data[pos]
+            cols = X.indices[pos]
+            
+            # sums over the values of each feature as a product with a segment matrix
+            indptr = np.concatenate(([0], np.cumsum(lengths[chunk])))
+            S = sps.csr_matrix((np.ones(seg.shape[0]), np.arange(seg.shape[0]), indptr),
+                               shape=(rows_chunk.shape[0], seg.shape[0]))
+            
+            v = self.fm.v[:, rows_chunk]
+            h = (data * (q[:, cols] - v[:, seg] * data)).T # values x k
+            
+            # same conditional as draw_v (no prior, unit precision of the e-terms)
+            A = S.dot((h[:, :, None] * h[:, None, :]).reshape(-1, k * k)).reshape(-1, k, k)
+            scale = 1 + A[:, diag, diag].max(axis=1)
+            A[:, diag, diag] += JOINT_JITTER * scale[:, None]
+            b = S.dot(h * self.cache[0, cols, None])
+            
+            # delta = A^-1 b (- L^-T z for the draw, z standard normal)
+            L = np.linalg.cholesky(A)
+            y = np.linalg.solve(L, b[:, :, None])
+            if noise is not None:
+                y -= noise[:, chunk].T[:, :, None]
+            delta = np.linalg.solve(np.swapaxes(L, 1, 2), y)[:, :, 0].T
+            deficient = np.flatnonzero(L[:, diag, diag].min(axis=1) ** 2 <= JOINT_RANK_TOL * scale)
+            delta[:, deficient] = 0
+            
+            self.fm.v[:, rows_chunk] = v - delta
+            self.cache[0, cols] -= np.sum(h * delta[:, seg].T, axis=1)
+            q[:, cols] -= delta[:, seg] * data
+            for i in deficient:
+                self.draw_v_factors(rows_chunk[i], None if noise is None else noise[:, chunk[i]], q)
+    
+    # Same as draw_v_joint for a single feature with many values: its precision 
+    # H^T H (k x k) and b are summed over slices of its values, whose h (values 
+    # x k) is recomputed to update the e-terms once v is drawn
+    def draw_v_joint_feature(self, row, noise, q):
+    
+        X = self.train.data_t
+        k = self.fm.num_factor
+        step = max(JOINT_CHUNK_SIZE // k, 1)
+        slices = [slice(start, min(start + step, X.indptr[row + 1])) 
+                  for start in xrange(X.indptr[row], X.indptr[row + 1], step)]
+        
+        v = np.copy(self.fm.v[:, row])
+        A = np.zeros((k, k))
+        b = np.zeros(k)
+        for values in slices:
+            data, cols = X.data[values], X.indices[values]
+            h = (data * (q[:, cols] - v[:, None] * data)).T # values x k
+            A += h.T.dot(h)
+            b += h.T.dot(self.cache[0, cols])
+        scale = 1 + A.diagonal().max()
+        A[np.arange(k), np.arange(k)] += JOINT_JITTER * scale
+        
+        L = np.linalg.cholesky(A)
+        if L.diagonal().min() ** 2 <= JOINT_RANK_TOL * scale:
+            self.draw_v_factors(row, noise, q)
+            return
+        y = np.linalg.solve(L, b)
+        if noise is not None:
+            y -= noise
+        delta = np.linalg.solve(L.T, y)
+        
+        self.fm.v[:, row] = v - delta
+        for values in slices:
+            data, cols = X.data[values], X.indices[values]
+            h = (data * (q[:, cols] - v[:, None] * data)).T
+            self.cache[0, cols] -= h.dot(delta)
+            q[:, cols] -= delta[:, None] * data
+    
+    # The k factors of a feature whose joint precision is singular, drawn one
+    # after the other with the conditional of draw_v
+    def draw_v_factors(self, row, noise, q):
+    
+        X = self.train.data_t
+        start, stop = X.indptr[row], X.indptr[row + 1]
+        data, cols = X.data[start:stop], X.indices[start:stop]
+        for f in xrange(self.fm.num_factor):
+            h = data * (q[f, cols] - self.fm.v[f, row] * data)
+            v_sigma_sqr = np.dot(h, h)
+            if v_sigma_sqr == 0:
+                continue # the feature is alone in all its cases
+            delta = np.dot(h, self.cache[0, cols]) / v_sigma_sqr
+            if noise is not None:
+                delta += np.sqrt(1.0 / v_sigma_sqr) * noise[f]
+            self.fm.v[f, row] -= delta
+            self.cache[0, cols] -= delta * h
+            q[f, cols] -= delta * data
+    
+    # Same as draw_w for the features of a relational block: the e-terms are
+    # summed per block row, the w are drawn on these sums and the e-terms of
+    # the cases are updated once at the end
+    def draw_w_rel(self, block, index, offset, noise=None):
+    
+        X = block.data_t
+        w = self.fm.w[offset:offset + block.num_feature]
+        w_start = np.copy(w)
+        
+        num_cases = np.bincount(index, minlength=block.num_cases).astype(float)
+        e = np.bincount(index, weights=self.cache[0], minlength=block.num_cases)
+        x_rows_sqr = block.tmp * num_cases # sum_c x_ci^2 for each feature
+        
+        for row, (start, stop) in enumerate(block.row_start_stop):
+            if x_rows_sqr[row] == 0:
+                continue # the feature is in no case
+            data = X.data[start:stop]
+            cols = X.indices[start:stop]
+            delta = np.dot(data, e[cols]) / x_rows_sqr[row]
+            w_old = w[row]
+            
+            if np.isinf(w[row]):
+                w[row] = 0
+            elif np.isnan(w[row]):
+                w[row] = 0
+            else:
+                if self.fm.do_sample : 
+                    w_sigma_sqr = 1.0 / x_rows_sqr[row]
+                    w[row] -= delta + np.sqrt(w_sigma_sqr) * noise[offset + row]
+                else:
+                    w[row] -= delta
+                    
+            e[cols] -= (w_old - w[row]) * data * num_cases[cols]
+        
+        self.cache[0] += block.dot_t(w - w_start)[index]
+    
+    # Same as draw_v for the features of a relational block. With q(c) = Q(c) + q_b,
+    # Q(c) the q-term of the features out of the block and q_b the one of the block
+    # row b of the case c, the sums of h(c)*e(c) and h(c)^2 over the cases only 
+    # need the per block row sums of e, Q, Q*e and Q^2
+    def draw_v_rel(self, f, block, index, offset, noise=None):
+    
+        X = block.data_t
+        v = self.fm.v[f, offset:offset + block.num_feature]
+        v_start = np.copy(v)
+        
+        q_start = block.dot_t(v)
+        q = np.copy(q_start)
+        Q = self.cache[1] - q[index]
+        num_cases = np.bincount(index, minlength=block.num_cases).astype(float)
+        e = np.bincount(index, weights=self.cache[0], minlength=block.num_cases)
+        Q_sum = np.bincount(index, weights=Q, minlength=block.num_cases)
+        Q_e = np.bincount(index, weights=Q * self.cache[0], minlength=block.num_cases)
+        Q_sqr = np.bincount(index, weights=Q * Q, minlength=block.num_cases)
+        
+        for row, (start, stop) in enumerate(block.row_start_stop):
+            data = X.data[start:stop]
+            cols = X.indices[start:stop]
+            
+            Y = q[cols] - v[row] * data
+            v_sigma_sqr = np.dot(data * data, Q_sqr[cols] + 2 * Y * Q_sum[cols] + Y * Y * num_cases[cols])
+            if v_sigma_sqr == 0:
+                continue
+            delta = np.dot(data, Q_e[cols] + Y * e[cols]) / v_sigma_sqr
+            v_old = v[row]
+            
+            if np.isinf(v[row]):
+                v[row] = 0
+            elif np.isnan(v[row]):
+                v[row] = 0
+            else:
+                if self.fm.do_sample : 
+                    v[row] -= delta + np.sqrt(1.0 / v_sigma_sqr) * noise[offset + row]
+                else:
+                    v[row] -= delta
+            
+            change = (v_old - v[row]) * data
+            q[cols] -= change
+            e[cols] -= change * (Q_sum[cols] + Y * num_cases[cols])
+            Q_e[cols] -= change * (Q_sqr[cols] + Y * Q_sum[cols])
+        
+        # e(c) += dq_b * Q(c) + 0.5 * (q_b^2 - q_start_b^2) - 0.5 * d(sum_i v_i^2 x_bi^2)
+        q_change = q - q_start
+        e_change = 0.5 * (q * q - q_start * q_start) - 0.5 * block.dot_t_sqr(v * v - v_start * v_start)
+        self.cache[0] += q_change[index] * Q + e_change[index]
+        self.cache[1] += q_change[index]
+        
     def draw_alpha(self): #ok
         if not self.fm.do_multilevel:
             self.alpha = self.alpha_0
@@ -445,7 +1156,7 @@ class MCMC_learn:
         gamma_n = self.gamma_0
         
         #print self.cache[0]
-        gamma_n = np.sum(self.cache[0] * self.cache[0])
+        gamma_n = np.sum(self.cache[0] * self.cache[0], dtype=np.float64)
         
         #alpha_old = self.alpha
         self.alpha = self.ran_gamma(alpha_n / 2.0, gamma_n / 2.0) 
@@ -458,15 +1169,10 @@ class MCMC_learn:
             self.w_mu *= self.mu_0
             return
 
-        w_mu_mean = self.cache_for_group_values
-        w_mu_mean.fill(0)
-        g = self.meta.attr_group
-        w_mu_mean = np.bincount(g, weights=self.fm.w)
-        
-        g = np.unique(g)
-        w_mu_mean = (w_mu_mean + self.beta_0 * self.mu_0) / (self.meta.num_attr_per_group[g] + self.beta_0)
-        w_mu_sigma_sqr = 1.0 / ((self.meta.num_attr_per_group[g] + self.beta_0) * self.w_lambda)
-        w_mu_old = self.w_mu
+        num_attr_per_group = self.meta.num_attr_per_group
+        w_mu_mean = self.meta.group_sum(self.fm.w)
+        w_mu_mean = (w_mu_mean + self.beta_0 * self.mu_0) / (num_attr_per_group + self.beta_0)
+        w_mu_sigma_sqr = 1.0 / ((num_attr_per_group + self.beta_0) * self.w_lambda)
         
         if self.fm.do_sample:
             self.w_mu = self.ran_gaussian(w_mu_mean, np.sqrt(w_mu_sigma_sqr))
@@ -480,16 +1186,10 @@ class MCMC_learn:
         if not self.fm.do_multilevel:
             return
         
-        #w_lambda_gamma = self.cache_for_group_values
         w_lambda_gamma = self.beta_0 * (self.w_mu - self.mu_0) * (self.w_mu - self.mu_0) + self.gamma_0
-        
-        g = self.meta.attr_group
-        w_lambda_gamma += np.bincount(g, weights=(self.fm.w - self.w_mu[g]) * (self.fm.w - self.w_mu[g]))
-        
-        g = np.unique(g)
-        w_lambda_alpha = self.alpha_0 + self.meta.num_attr_per_group[g] + 1
-        #w_lambda_old = self.w_lambda
-        
+        w_diff = self.fm.w - self.w_mu[self.meta.attr_group]
+        w_lambda_gamma += self.meta.group_sum(w_diff * w_diff)
+        w_lambda_alpha = self.alpha_0 + self.meta.num_attr_per_group + 1
 
         if self.fm.do_sample:
             self.w_lambda = self.ran_gamma(w_lambda_alpha / 2.0, w_lambda_gamma / 2.0)
@@ -504,165 +1204,1477 @@ class MCMC_learn:
             self.v_mu *= self.mu_0
             return
 
-        v_mu_mean = self.cache_for_group_values
+        # all the (group, factor) pairs at once, computed as (factor, group) arrays
+        num_attr_per_group = self.meta.num_attr_per_group
+        v_mu_mean = self.meta.group_sum(self.fm.v)
+        v_mu_mean = (v_mu_mean + self.beta_0 * self.mu_0) / (num_attr_per_group + self.beta_0)
+        v_mu_sigma_sqr = 1.0 / ((num_attr_per_group + self.beta_0) * self.v_lambda.T)
         
-        g = self.meta.attr_group
-        for f in xrange(self.fm.num_factor):
-            v_mu_mean.fill(0)
-            v_mu_mean = np.bincount(g, weights=self.fm.v[f])
- 
-            #print self.beta_0, v_mu_mean, self.mu_0, self.meta.num_attr_per_group, self.v_lambda[:, f]
-            v_mu_mean = (v_mu_mean + self.beta_0 * self.mu_0) / (self.meta.num_attr_per_group + self.beta_0)
-            v_mu_sigma_sqr = 1.0 / ((self.meta.num_attr_per_group + self.beta_0) * self.v_lambda[:, f])
-            #v_mu_old = self.v_mu[:,f]
-            
-            if self.fm.do_sample:
-                self.v_mu[:,f] = self.ran_gaussian(v_mu_mean, np.sqrt(v_mu_sigma_sqr))
-            else:
-                self.v_mu[:,f] = v_mu_mean
+        if self.fm.do_sample:
+            self.v_mu = self.ran_gaussian(v_mu_mean, np.sqrt(v_mu_sigma_sqr)).T
+        else:
+            self.v_mu = v_mu_mean.T
        
     def draw_v_lambda(self): #Ok
         if not self.fm.do_multilevel:
             return
             
-        for f in xrange(self.fm.num_factor):
-            v_lambda_gamma = self.beta_0 * (self.v_mu[:,f] - self.mu_0) * (self.v_mu[:,f] - self.mu_0) + self.gamma_0
-            
-            g = self.meta.attr_group
-            v_lambda_gamma += np.bincount(g, weights=((self.fm.v[f,:] - self.v_mu[g,f]) * (self.fm.v[f,:] - self.v_mu[g,f])) )
-
-            g = np.unique(g)
-            v_lambda_alpha = self.alpha_0 + self.meta.num_attr_per_group[g] + 1
-            #v_lambda_old = self.v_lambda[:,f]
-            if self.fm.do_sample:
-                self.v_lambda[:,f] = self.ran_gamma(v_lambda_alpha / 2.0, v_lambda_gamma / 2.0)
-            else:
-                self.v_lambda[:,f] = v_lambda_alpha / v_lambda_gamma
+        # all the (group, factor) pairs at once, computed as (factor, group) arrays
+        v_mu = self.v_mu.T
+        v_lambda_gamma = self.beta_0 * (v_mu - self.mu_0) * (v_mu - self.mu_0) + self.gamma_0
+        v_diff = self.fm.v - v_mu[:, self.meta.attr_group]
+        v_lambda_gamma += self.meta.group_sum(v_diff * v_diff)
+        v_lambda_alpha = (self.alpha_0 + self.meta.num_attr_per_group + 1) * np.ones_like(v_lambda_gamma)
+        
+        if self.fm.do_sample:
+            self.v_lambda = self.ran_gamma(v_lambda_alpha / 2.0, v_lambda_gamma / 2.0).T
+        else:
+            self.v_lambda = (v_lambda_alpha / v_lambda_gamma).T
        
 
     ##################################
     ########### Random.h #############
     ##################################
 
+    def substream(self, *key):
+        """ 
+        Independent random stream of the draws keyed by (seed, stream, iteration, key),
+        e.g. the sweep and the factor or a block of features. 
+        """
+        return np.random.RandomState([self.seed] + self.stream + [self.iteration] + list(key))
+
+    def sweep_noise(self, shape, *key):
+        """ Standard normals of a sweep (one per feature) from the substream key, None for ALS """
+        if not self.fm.do_sample:
+            return None
+        return self.substream(*key).standard_normal(shape)
+
     def ran_gaussian(self, mean, stdev):
-        return mean + stdev * np.random.randn()
+        return mean + stdev * self.random.standard_normal(np.shape(mean) or None)
         
     def ran_gamma(self, alpha, beta):
-        tmp = np.random.gamma(alpha, 1/beta)
+        tmp = self.random.gamma(alpha, 1/beta)
         if isinstance(tmp, float):
             return np.asarray([tmp])
         else:
             return tmp
         
 
+####################################
+########## Parallel chains #########
+####################################
+
+# (meta, train, test) of run_chains, inherited by the forked workers
+_CHAIN_DATA = None
+
+def run_chain(args):
+    """ Run the MCMC chain of seed on the data of run_chains (run in a worker process) """
+    seed, fm_kwargs, burn, mcmc_kwargs = args
+    meta, train, test = _CHAIN_DATA
+    fm = libFM(meta.attr_group.shape[0], seed=seed, method='mcmc', **fm_kwargs)
+    fm.save = False
+    mcmc = MCMC_learn(fm, meta, train, test, burn, pred_var=True, **mcmc_kwargs)
+    mcmc.learn()
+    return mcmc.posterior, mcmc.history, mcmc.num_iter_done
+
+
+def run_chains(meta, train, test, burn, num_chains, num_workers=1, seed=None, fm_kwargs={}, **mcmc_kwargs):
+    """
+    Run num_chains independent MCMC chains (seeds seed, seed + 1, ...) on a 
+    pool of num_workers processes. The structures of the data are built once 
+    here and the forked workers share them (copy-on-write) instead of reading 
+    the files again. fm_kwargs go to libFM and mcmc_kwargs to MCMC_learn.
+    
+    Return the pooled test prediction, its R-hat per case (see pool_chains) 
+    and the (posterior, history, num_iter_done) of each chain.
+    """
+    global _CHAIN_DATA
+    if seed is None or seed < 0:
+        seed = np.random.randint(1 << 30)
+    train.data_t
+    for block, index, offset in train.iter_relations():
+        block.data_t
+    if mcmc_kwargs.get('colored') or mcmc_kwargs.get('num_threads', 1) > 1 or mcmc_kwargs.get('joint'):
+        train.color_classes
+    test.X
+    
+    _CHAIN_DATA = meta, train, test
+    args = [(seed + chain, fm_kwargs, burn, mcmc_kwargs) for chain in xrange(num_chains)]
+    try:
+        if num_workers > 1:
+            pool = multiprocessing.Pool(num_workers)
+            try:
+                chains = pool.map(run_chain, args)
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            chains = map(run_chain, args)
+    finally:
+        _CHAIN_DATA = None
+    
+    pred, r_hat = pool_chains([posterior for posterior, history, num_iter_done in chains])
+    return pred, r_hat, chains
+
+
+def pool_chains(posteriors):
+    """
+    Mean of the RunningMean (with variance) of the chains weighted by their 
+    number of samples, and the Gelman-Rubin R-hat of each case: 
+    sqrt(((n - 1) / n W + B / n) / W) with W the mean of the within chain 
+    variances, B / n the variance of the chain means and n the smallest number
+    of samples of a chain. Close to 1 when the chains agree. The R-hat is nan
+    with less than 2 chains or 2 samples per chain, 1 for constant cases.
+    """
+    num_samples = np.array([posterior.num_samples for posterior in posteriors], dtype=float)
+    if not num_samples.sum():
+        raise Exception('No sample kept, burn >= number of iterations')
+    means = np.array([posterior.mean for posterior in posteriors])
+    pred = np.dot(num_samples, means) / num_samples.sum()
+    
+    n = num_samples.min()
+    r_hat = np.nan * np.ones(pred.shape[0])
+    if len(posteriors) > 1 and n > 1:
+        W = np.mean([posterior.m2 / (posterior.num_samples - 1) for posterior in posteriors], axis=0)
+        var_plus = (n - 1) / n * W + np.var(means, axis=0, ddof=1)
+        constant = W == 0
+        r_hat = np.sqrt(var_plus / np.where(constant, 1, W))
+        r_hat[constant] = 1.0
+    return pred, r_hat
+
+
+####################################
+########## Consensus MCMC ##########
+####################################
+
+# Protocol between run_consensus (the coordinator) and consensus_worker, over 
+# multiprocessing.connection (pickled (kind, payload) messages on a socket):
+#   coordinator -> worker : ('shard', dict(shard, seed, num_attribute, target, X, burn, fm_kwargs, mcmc_kwargs))
+#   worker -> coordinator : ('samples', dict(shard, w0, w, v)) or ('error', traceback)
+# The messages are unpickled, i.e. whoever knows the authkey can run code on the
+# other side: the authkey is a secret, never a default.
+CONSENSUS_AUTHKEY_ENV = 'LIBFM_SHARD_AUTHKEY'
+
+def is_loopback(host):
+    return host in ('localhost', '::1') or host.startswith('127.')
+
+
+def get_consensus_authkey(authkey=None, generate=False):
+    """
+    The secret authkey of the consensus connections: authkey, else the 
+    CONSENSUS_AUTHKEY_ENV environment variable, else a random one if generate
+    (local workers only, it is never shared outside the process tree).
+    """
+    if not authkey:
+        authkey = os.environ.get(CONSENSUS_AUTHKEY_ENV)
+    if not authkey and generate:
+        authkey = os.urandom(32)
+    if not authkey:
+        raise Exception('The consensus connections need a secret authkey (-shard_authkey or %s)' 
+                        % CONSENSUS_AUTHKEY_ENV)
+    return authkey
+
+
+def consensus_worker(address, authkey=None):
+    """
+    Connect to the coordinator at address (host, port), run the MCMC chain of
+    the shard it sends and send back the kept samples (num_samples x ...).
+    authkey is the secret of the coordinator, see get_consensus_authkey.
+    """
+    conn = Client(address, authkey=get_consensus_authkey(authkey))
+    try:
+        kind, shard = conn.recv()
+        assert kind == 'shard'
+        try:
+            w0, w, v = sample_shard(**shard)
+            conn.send(('samples', dict(shard=shard['shard'], w0=w0, w=w, v=v)))
+        except Exception:
+            conn.send(('error', traceback.format_exc()))
+    finally:
+        conn.close()
+
+
+def sample_shard(shard, seed, num_attribute, target, X, burn, fm_kwargs, mcmc_kwargs):
+    """ Kept samples (w0, w, v) of the MCMC chain of the rows (target, X) of a shard, from the initial model of seed """
+    train = Data.from_csr(target, X, False, True, role='train')
+    test = Data.from_csr(np.zeros(0), sps.csr_matrix((0, num_attribute)), True, False, role='eval')
+    fm = libFM(num_attribute, seed=seed, method='mcmc', **fm_kwargs)
+    fm.save = False
+    mcmc_kwargs = dict(mcmc_kwargs)
+    mcmc_kwargs.setdefault('eval_every', 0)
+    mcmc = MCMC_learn(fm, DataMetaInfo(num_attribute), train, test, burn, keep_samples=True, stream=[shard], 
+                      **mcmc_kwargs)
+    mcmc.learn()
+    if not mcmc.samples:
+        raise Exception('No sample kept, burn >= number of iterations')
+    w0, w, v = zip(*mcmc.samples)
+    return np.array(w0), None if w[0] is None else np.array(w), None if v[0] is None else np.array(v)
+
+
+def run_consensus(train, test, num_shards, burn, seed=None, fm_kwargs={}, address=('localhost', 0),
+                  authkey=None, local_workers=True, **mcmc_kwargs):
+    """
+    Consensus MCMC: the rows of train (no relation) are split in num_shards 
+    contiguous shards, each sampled by a consensus_worker, and the samples of
+    the shards are combined by consensus_draws. The coordinator listens on 
+    address; with local_workers it starts num_shards local worker processes,
+    else it waits for num_shards consensus_worker (e.g. on other hosts).
+    The connections are authenticated by the secret authkey (see 
+    get_consensus_authkey), which is required unless the local workers of 
+    a loopback address share a random one.
+    
+    The draws of w and v do not use their prior (flat prior) in any mode 
+    (sequential, colored, jacobi or joint, see draw_v_joint), so the prior
+    fraction 1/num_shards of each shard leaves its conditionals unchanged. All
+    the shards start from the same w and v (same seed), which keeps them in 
+    the same mode of v, their draws are independent (stream of the shard). 
+    
+    Return the test prediction (mean over the consensus draws, clipped to the
+    train targets) and the consensus draws (w0, w, v).
+    """
+    if train.relations:
+        raise Exception('The consensus does not support the relational blocks')
+    if seed is None or seed < 0:
+        seed = np.random.randint(1 << 30)
+    X = train.X
+    shards = np.array_split(np.arange(train.num_cases), num_shards)
+    authkey = get_consensus_authkey(authkey, generate=local_workers and is_loopback(address[0]))
+    
+    listener = Listener(address, authkey=authkey)
+    print "consensus_address= %s:%d" % listener.address[:2]
+    workers = []
+    try:
+        if local_workers:
+            for shard in xrange(num_shards):
+                worker = multiprocessing.Process(target=consensus_worker, args=(listener.address, authkey))
+                worker.daemon = True
+                worker.start()
+                workers.append(worker)
+        conns = []
+        for shard, rows in enumerate(shards):
+            conn = listener.accept()
+            conn.send(('shard', dict(shard=shard, seed=seed, num_attribute=X.shape[1], 
+                                     target=train.target_value[rows], X=X[rows], burn=burn, 
+                                     fm_kwargs=fm_kwargs, mcmc_kwargs=mcmc_kwargs)))
+            conns.append(conn)
+        samples = [None] * num_shards
+        for conn in conns:
+            kind, payload = conn.recv()
+            conn.close()
+            if kind == 'error':
+                raise Exception('Consensus worker failed:\n' + payload)
+            samples[payload['shard']] = payload
+    finally:
+        listener.close()
+        for worker in workers:
+            worker.join()
+    
+    present = [np.bincount(X[rows].indices, minlength=X.shape[1]) > 0 for rows in shards]
+    draws = consensus_draws(samples, present)
+    
+    fm = libFM(X.shape[1], seed=seed, method='mcmc', **fm_kwargs)
+    posterior = RunningMean(test.num_cases)
+    for w0, w, v in zip(*draws):
+        fm.w0, fm.w, fm.v = w0, w, v
+        posterior.add(np.clip(predict_fm(fm, test), train.min_target, train.max_target))
+    return posterior.mean, draws
+
+
+def consensus_draws(samples, present):
+    """
+    Consensus draws of the samples (dicts of w0, w, v, num_samples x ...) of 
+    the shards: the t-th draw is the average of the t-th samples of the 
+    shards weighted by the inverse of their variance over the samples of the
+    shard (per parameter). present[s] are the features of shard s, the others
+    get a weight of 0 (and 0 if in no shard).
+    """
+    num_samples = min(shard['w0'].shape[0] for shard in samples)
+    draws = []
+    for name in ['w0', 'w', 'v']:
+        if samples[0][name] is None:
+            draws.append([None] * num_samples)
+            continue
+        total = np.zeros(samples[0][name].shape[1:])
+        draw = np.zeros((num_samples,) + total.shape)
+        for shard, mask in zip(samples, present):
+            theta = shard[name][:num_samples]
+            if name != 'w0':
+                theta = np.where(mask, theta, 0)
+            weight = 1.0 / np.maximum(np.var(theta, axis=0), 1e-300)
+            if name != 'w0':
+                weight = np.where(mask, weight, 0)
+            total += weight
+            draw += weight * theta
+        draws.append(draw / np.where(total > 0, total, 1))
+    return draws
+        
+
+####################################
+############# Kernels ##############
+####################################
+
+# The per-feature loops of MCMC_learn.draw_w and draw_v over the features rows of the 
+# transposed design matrix (indptr, indices, data), written for numba. noise is the
+# standard normal of each of the rows (empty for ALS). e, q, w and v are updated in
+# place. They run the sequential sweeps and the blocks of the colored ones.
+
+def draw_w_kernel(indptr, indices, data, rows, x_rows_sqr, w, e, noise, do_sample):
+    for i in range(rows.shape[0]):
+        row = rows[i]
+        start, stop = indptr[row], indptr[row + 1]
+        delta = 0.0
+        for j in range(start, stop):
+            delta += data[j] * e[indices[j]]
+        delta /= x_rows_sqr[row]
+        
+        if np.isinf(w[row]) or np.isnan(w[row]):
+            w[row] = 0
+        else:
+            if do_sample:
+                delta += np.sqrt(1.0 / x_rows_sqr[row]) * noise[i]
+            w[row] -= delta
+        
+        for j in range(start, stop):
+            e[indices[j]] -= delta * data[j]
+
+
+def draw_v_kernel(indptr, indices, data, rows, v, q, e, noise, do_sample):
+    for i in range(rows.shape[0]):
+        row = rows[i]
+        start, stop = indptr[row], indptr[row + 1]
+        v_old = v[row]
+        v_sigma_sqr = 0.0
+        delta = 0.0
+        for j in range(start, stop):
+            h = data[j] * (q[indices[j]] - v_old * data[j])
+            v_sigma_sqr += h * h
+            delta += h * e[indices[j]]
+        if v_sigma_sqr == 0:
+            continue # the feature is alone in all its cases
+        delta /= v_sigma_sqr
+        
+        if np.isinf(v_old) or np.isnan(v_old):
+            v[row] = 0
+        else:
+            if do_sample:
+                delta += np.sqrt(1.0 / v_sigma_sqr) * noise[i]
+            v[row] -= delta
+        
+        for j in range(start, stop):
+            h = data[j] * (q[indices[j]] - v_old * data[j])
+            q[indices[j]] -= delta * data[j]
+            e[indices[j]] -= delta * h
+
+
+KERNELS = {'draw_w': draw_w_kernel, 'draw_v': draw_v_kernel}
+_numba_kernels = {}
+
+def get_kernels(backend='numpy'):
+    """
+    Kernels of the per-feature loops of draw_w/draw_v for a backend:
+    'numpy' : None, the vectorized methods of MCMC_learn (the reference)
+    'numba' : the kernels compiled (without the GIL) by numba
+    'auto' : 'numba' when numba is installed, else 'numpy'
+    'python' : the kernels not compiled (slow, to check them)
+    """
+    if backend == 'auto':
+        backend = 'numpy' if numba is None else 'numba'
+    if backend == 'numpy':
+        return None
+    if backend == 'python':
+        return KERNELS
+    if backend == 'numba':
+        if numba is None:
+            raise ImportError('The numba backend needs numba')
+        if not _numba_kernels:
+            for name, kernel in KERNELS.items():
+                _numba_kernels[name] = numba.njit(nogil=True, error_model='numpy')(kernel)
+        return _numba_kernels
+    raise Exception('Unknown backend')
+
+
+####################################
+####################################
+####################################
+
+class GrowableArray:
+    """
+    1-D numpy buffer that doubles its capacity when it is full, so values
+    can be appended chunk by chunk without knowing the final size.
+    """
+    def __init__(self, dtype, capacity=1024):
+        self.array = np.empty(max(capacity, 1), dtype=dtype)
+        self.size = 0
+
+    def extend(self, values):
+        end = self.size + values.shape[0]
+        if end > self.array.shape[0]:
+            capacity = self.array.shape[0]
+            while capacity < end:
+                capacity *= 2
+            array = np.empty(capacity, dtype=self.array.dtype)
+            array[:self.size] = self.array[:self.size]
+            self.array = array
+        self.array[self.size:end] = values
+        self.size = end
+
+    def view(self):
+        return self.array[:self.size]
+
+
+COMPRESSION_EXTENSIONS = {'.gz': 'gzip', '.bz2': 'bz2', '.xz': 'xz'}
+COMPRESSION_MAGIC = [('\x1f\x8b', 'gzip'), ('BZh', 'bz2'), ('\xfd7zXZ\x00', 'xz')]
+
+def get_compression(filename):
+    """ Codec of the file ('gzip', 'bz2', 'xz' or None), from its extension or else its magic bytes """
+    ext = os.path.splitext(filename)[1].lower()
+    if ext in COMPRESSION_EXTENSIONS:
+        return COMPRESSION_EXTENSIONS[ext]
+    with open(filename, 'rb') as f:
+        head = f.read(6)
+    for magic, codec in COMPRESSION_MAGIC:
+        if head.startswith(magic):
+            return codec
+    return None
+
+
+class ThreadedReader:
+    """
+    Read a (decompressing) file object on a background thread which feeds
+    a bounded queue of chunks, so the decompression overlaps with the parsing
+    done by the consumer of read().
+    """
+    def __init__(self, f, chunk_size=1<<22, max_chunks=4):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.queue = Queue.Queue(max_chunks)
+        self.buffer = ''
+        self.eof = False
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._produce)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _put(self, item):
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _produce(self):
+        try:
+            while True:
+                chunk = self.f.read(self.chunk_size)
+                if not self._put(chunk) or not chunk:
+                    return
+        except Exception as e:
+            self._put(e)
+
+    def read(self, size):
+        while len(self.buffer) < size and not self.eof:
+            chunk = self.queue.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            if not chunk:
+                self.eof = True
+            self.buffer += chunk
+        chunk, self.buffer = self.buffer[:size], self.buffer[size:]
+        return chunk
+
+    def close(self):
+        self.stop.set()
+        self.thread.join()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_libfm(filename, chunk_size=1<<22):
+    """
+    Open a libFM file for binary reading. gzip, bz2 and xz files are
+    decompressed on the fly by a background thread (see ThreadedReader).
+    """
+    codec = get_compression(filename)
+    if codec is None:
+        return open(filename, 'rb')
+    if codec == 'gzip':
+        f = gzip.GzipFile(filename, 'rb')
+    elif codec == 'bz2':
+        f = bz2.BZ2File(filename, 'rb')
+    elif lzma is not None:
+        f = lzma.LZMAFile(filename, 'rb')
+    else:
+        raise Exception('Reading xz files needs the lzma module (backports.lzma with python 2)')
+    return ThreadedReader(f, chunk_size)
+
+
+def iter_libfm_blocks(f, chunk_size=1<<24):
+    """
+    Read f by chunks of about chunk_size bytes and yield blocks made only of
+    complete lines (the last partial line is carried over to the next block).
+    """
+    rest = ''
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        chunk = rest + chunk
+        cut = chunk.rfind('\n') + 1
+        if cut == 0:
+            rest = chunk
+            continue
+        rest = chunk[cut:]
+        yield chunk[:cut]
+    if rest.strip():
+        yield rest + '\n'
+
+
+def parse_raw_ids(buf, is_space):
+    """
+    The ids (the digits before each ':') of the bytes buf of a libFM block as
+    exact uint64, summed a digit position at a time over all the ids
+    """
+    colon = np.flatnonzero(buf == ord(':'))
+    last_space = np.maximum.accumulate(np.where(is_space, np.arange(buf.shape[0]), -1))
+    length = colon - (last_space[colon] + 1)
+    if colon.shape[0] and (length.min() < 1 or length.max() > 20):
+        raise ValueError('Malformed libFM data: feature ids must be 64 bits non negative integers')
+    
+    ids = np.zeros(colon.shape[0], dtype=np.uint64)
+    for j in xrange(int(length.max()) if colon.shape[0] else 0):
+        has_digit = length > j
+        digit = buf[colon[has_digit] - 1 - j] - np.uint8(ord('0')) # wraps below '0'
+        if np.any(digit > 9):
+            raise ValueError('Malformed libFM data: feature ids must be 64 bits non negative integers')
+        ids[has_digit] += digit.astype(np.uint64) * np.uint64(10 ** j)
+    return ids
+
+
+def parse_libfm_block(block, raw_ids=False):
+    """
+    Parse a block of complete libFM lines 'target id:value id:value ...'.
+    The tokenization is done with vectorized numpy operations on the raw bytes:
+    the lines are located with the newlines, the number of features of each
+    line is the number of ':' in it, and all the numbers are read at once.
+    With raw_ids the ids are read exactly as 64 bits integers (uint64) for
+    feature hashing, instead of non negative int64.
+
+    Returns (target, num_features_per_row, ids, values)
+    """
+    buf = np.frombuffer(block, dtype=np.uint8)
+    newline = np.flatnonzero(buf == ord('\n'))
+    start = np.concatenate(([0], newline + 1))
+    stop = np.concatenate((newline, [buf.shape[0]]))
+
+    # skip the blank lines
+    is_space = (buf == ord(' ')) | (buf == ord('\t')) | (buf == ord('\n')) | (buf == ord('\r'))
+    count = np.concatenate(([0], np.cumsum(~is_space)))
+    not_blank = (count[stop] - count[start]) > 0
+    start, stop = start[not_blank], stop[not_blank]
+    if start.shape[0] == 0:
+        return np.zeros(0), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint64 if raw_ids else np.int64), np.zeros(0)
+
+    count = np.concatenate(([0], np.cumsum(buf == ord(':'))))
+    row_nnz = count[stop] - count[start]
+
+    numbers = np.fromstring(block.replace(':', ' '), dtype=np.float64, sep=' ')
+    if numbers.shape[0] != row_nnz.shape[0] + 2 * np.sum(row_nnz):
+        raise ValueError('Malformed libFM data: expected "target id:value ..." lines')
+
+    is_target = np.zeros(numbers.shape[0], dtype=bool)
+    is_target[np.cumsum(1 + 2 * row_nnz) - (1 + 2 * row_nnz)] = True
+    target = numbers[is_target]
+    pairs = numbers[~is_target]
+    ids, values = pairs[0::2], pairs[1::2]
+    if raw_ids:
+        # the float64 numbers are not exact for ids >= 2**53 (e.g. 64 bits hashes)
+        return target, row_nnz, parse_raw_ids(buf, is_space), values
+    if np.any(ids < 0) or np.any(ids != np.floor(ids)):
+        raise ValueError('Malformed libFM data: feature ids must be non negative integers')
+
+    return target, row_nnz, ids.astype(np.int64), values
+
+
+def hash_features(ids, num_buckets):
+    """
+    Map raw feature ids (uint64) to [0, num_buckets) with the splitmix64 finalizer.
+    The mapping only depends on num_buckets so it is the same for every file.
+    Raw ids of a row which share a bucket are summed by the readers (see sum_duplicate_features).
+    """
+    if not 0 < num_buckets <= np.iinfo(np.int32).max: # the indices are stored as int32
+        raise ValueError('num_buckets must be between 1 and %d' % np.iinfo(np.int32).max)
+    z = ids.astype(np.uint64)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    z = z ^ (z >> np.uint64(31))
+    return (z % np.uint64(num_buckets)).astype(np.int32)
+
+
+def get_hash_stats(raw_ids, num_buckets):
+    """ Collision statistics of the hashing of the distinct raw feature ids raw_ids """
+    num_raw_features = raw_ids.shape[0]
+    num_used_buckets = np.unique(hash_features(raw_ids, num_buckets)).shape[0]
+    return {'num_buckets': num_buckets,
+            'num_raw_features': num_raw_features,
+            'num_used_buckets': num_used_buckets,
+            'num_collisions': num_raw_features - num_used_buckets, # raw ids sharing a bucket with a previous one
+            'collision_rate': (num_raw_features - num_used_buckets) / float(max(num_raw_features, 1))}
+
+
+def implicit_values(num_values, dtype=np.float64):
+    """ Array of num_values ones which takes no memory (all its items are the same float) """
+    return as_strided(np.ones(1, dtype=dtype), shape=(num_values,), strides=(0,))
+
+
+# products of the implicit_ones data: number of values of the chunks of rows whose
+# temporaries (the value of each nonzero) are built at once
+IMPLICIT_CHUNK_SIZE = 1 << 22
+
+def row_chunks(indptr, chunk_size):
+    """ (start, stop) of the chunks of consecutive rows of a CSR matrix with about chunk_size values """
+    num_rows = indptr.shape[0] - 1
+    bounds = np.searchsorted(indptr, np.arange(chunk_size, indptr[-1], chunk_size))
+    bounds = np.unique(np.concatenate(([0], np.minimum(bounds, num_rows), [num_rows])))
+    return zip(bounds[:-1], bounds[1:])
+
+
+def implicit_dot(X, v):
+    """ X.dot(v) for a CSR matrix X of implicit ones (a row sum of v at its indices per row) """
+    out = np.zeros(X.shape[0])
+    nonempty = np.diff(X.indptr) > 0
+    for start, stop in row_chunks(X.indptr, IMPLICIT_CHUNK_SIZE):
+        rows = start + np.flatnonzero(nonempty[start:stop])
+        if rows.shape[0]:
+            offset = X.indptr[start]
+            out[rows] = np.add.reduceat(v[X.indices[offset:X.indptr[stop]]], X.indptr[rows] - offset, dtype=np.float64)
+    return out
+
+
+def implicit_dot_t(X, v):
+    """ v * X for a CSR matrix X of implicit ones (v_i added to the columns of row i) """
+    out = np.zeros(X.shape[1])
+    # at least X.shape[1] values per chunk: the bincounts take as much time as the values
+    for start, stop in row_chunks(X.indptr, max(IMPLICIT_CHUNK_SIZE, X.shape[1])):
+        values = slice(X.indptr[start], X.indptr[stop])
+        out += np.bincount(X.indices[values], weights=np.repeat(v[start:stop], np.diff(X.indptr[start:stop + 1])), 
+                           minlength=X.shape[1])
+    return out
+
+
+def check_implicit_values(values):
+    if np.any(values != 1):
+        raise ValueError('implicit_ones needs binary features (all the values equal to 1)')
+
+
+def check_feature_ids(ids):
+    # the indices are stored as int32
+    if ids.shape[0] and ids.max() > np.iinfo(np.int32).max:
+        raise ValueError('Feature id %d does not fit in 32 bits, hash the ids with num_buckets (-hash_buckets)' 
+                         % ids.max())
+
+
+def sum_duplicate_features(X, implicit_ones=False):
+    """
+    Sum the values of the features repeated in a row of the csr_matrix X
+    (e.g. '3:1 3:1'), like the conversion of a coo_matrix does: the sampler
+    needs a single value per (case, feature). With implicit_ones a repeated
+    binary feature is kept once. The indices of the rows end up sorted.
+    """
+    if not implicit_ones:
+        X.sum_duplicates()
+        return X
+    if X.has_canonical_format:
+        return X
+    B = sps.csr_matrix((np.ones(X.nnz, dtype=np.bool_), X.indices.copy(), X.indptr.copy()), shape=X.shape)
+    B.sum_duplicates()
+    return sps.csr_matrix((implicit_values(B.nnz, X.dtype), B.indices, B.indptr), shape=X.shape)
+
+
+def read_libfm(filename, chunk_size=1<<24, num_workers=1, dtype=np.float64, implicit_ones=False,
+               num_buckets=None, hash_stats=None):
+    """
+    Read a libFM file in a single pass.
+
+    Returns (target, min_target, max_target, num_feature, X)
+    with X the csr_matrix (num_rows x num_feature) of the file; its transpose
+    in csr (i.e. the CSC of X) is what the sampler uses.
+    With num_workers > 1 the file is parsed by a pool of processes (see read_libfm_parallel),
+    compressed files (see open_libfm) are always read by a single stream.
+    The values are stored with dtype, or not at all with implicit_ones (binary features),
+    the values of a feature repeated in a row are summed (see sum_duplicate_features).
+    With num_buckets the raw ids are hashed to num_buckets features (see hash_features)
+    and the collision statistics are put in the dict hash_stats.
+    """
+    if num_workers > 1 and get_compression(filename) is None:
+        return read_libfm_parallel(filename, num_workers, chunk_size, dtype, implicit_ones, 
+                                   num_buckets, hash_stats)
+    
+    target = GrowableArray(np.float64)
+    indptr = GrowableArray(np.int64)
+    indices = GrowableArray(np.int32)
+    values = GrowableArray(dtype)
+    indptr.extend(np.zeros(1, dtype=np.int64))
+    num_feature = 0
+    raw_ids = [] # distinct raw ids of each block
+
+    with open_libfm(filename) as f:
+        for block in iter_libfm_blocks(f, chunk_size):
+            _target, _row_nnz, _ids, _values = parse_libfm_block(block, num_buckets is not None)
+            if num_buckets is not None:
+                raw_ids.append(np.unique(_ids))
+                _ids = hash_features(_ids, num_buckets)
+            elif _ids.shape[0]:
+                check_feature_ids(_ids)
+                num_feature = max(num_feature, int(_ids.max()) + 1)
+            target.extend(_target)
+            indptr.extend(indptr.array[indptr.size - 1] + np.cumsum(_row_nnz))
+            indices.extend(_ids)
+            if implicit_ones:
+                check_implicit_values(_values)
+            else:
+                values.extend(_values)
+
+    target, indptr, indices = target.view(), indptr.view(), indices.view()
+    values = implicit_values(indices.shape[0], dtype) if implicit_ones else values.view()
+    if target.shape[0]:
+        min_target, max_target = target.min(), target.max()
+    else:
+        min_target, max_target = float("inf"), -float("inf")
+
+    if num_buckets is not None:
+        num_feature = num_buckets
+        if hash_stats is not None:
+            hash_stats.update(get_hash_stats(np.unique(np.concatenate(raw_ids or [np.zeros(0, dtype=np.uint64)])), 
+                                             num_buckets))
+
+    if indptr[-1] < np.iinfo(np.int32).max:
+        indptr = indptr.astype(np.int32)
+    X = sps.csr_matrix((values, indices, indptr), shape=(target.shape[0], num_feature))
+    return target, min_target, max_target, num_feature, sum_duplicate_features(X, implicit_ones)
+
+
+class FileRange:
+    """ Read-only view on the bytes [start, stop) of an opened file """
+    def __init__(self, f, start, stop):
+        self.f = f
+        self.f.seek(start)
+        self.remaining = stop - start
+
+    def read(self, size):
+        size = min(size, self.remaining)
+        if size <= 0:
+            return ''
+        chunk = self.f.read(size)
+        self.remaining -= len(chunk)
+        return chunk
+
+
+def split_libfm_file(filename, num_parts):
+    """ Split the file in about num_parts byte ranges which start at the beginning of a line """
+    size = os.path.getsize(filename)
+    offsets = [0]
+    with open(filename, 'rb') as f:
+        for k in xrange(1, num_parts):
+            f.seek(max(k * size // num_parts - 1, offsets[-1]))
+            f.readline()
+            offsets.append(min(f.tell(), size))
+    offsets.append(size)
+    offsets = sorted(set(offsets))
+    return zip(offsets[:-1], offsets[1:])
+
+
+def read_libfm_range(args):
+    """ Parse the lines of the byte range [start, stop) of a libFM file (run in a worker process) """
+    filename, start, stop, chunk_size, dtype, implicit_ones, num_buckets = args
+    target = GrowableArray(np.float64)
+    row_nnz = GrowableArray(np.int64)
+    indices = GrowableArray(np.int32)
+    values = GrowableArray(dtype)
+    raw_ids = [np.zeros(0, dtype=np.uint64)] # distinct raw ids of each block
+    with open(filename, 'rb') as f:
+        for block in iter_libfm_blocks(FileRange(f, start, stop), chunk_size):
+            _target, _row_nnz, _ids, _values = parse_libfm_block(block, num_buckets is not None)
+            if num_buckets is not None:
+                raw_ids.append(np.unique(_ids))
+                _ids = hash_features(_ids, num_buckets)
+            else:
+                check_feature_ids(_ids)
+            target.extend(_target)
+            row_nnz.extend(_row_nnz)
+            indices.extend(_ids)
+            if implicit_ones:
+                check_implicit_values(_values)
+            else:
+                values.extend(_values)
+    return (target.view(), row_nnz.view(), indices.view(), None if implicit_ones else values.view(), 
+            np.unique(np.concatenate(raw_ids)))
+
+
+def read_libfm_parallel(filename, num_workers, chunk_size=1<<24, dtype=np.float64, implicit_ones=False,
+                        num_buckets=None, hash_stats=None):
+    """
+    Same as read_libfm but the file is split in byte ranges aligned on the
+    lines, which are parsed by a pool of num_workers processes. The partial
+    blocks are copied once, in order, into the final arrays.
+    """
+    ranges = split_libfm_file(filename, num_workers)
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        parts = pool.map(read_libfm_range, [(filename, start, stop, chunk_size, dtype, implicit_ones, num_buckets) 
+                                            for start, stop in ranges])
+    finally:
+        pool.terminate()
+        pool.join()
+    
+    num_rows = sum(part[0].shape[0] for part in parts)
+    num_values = sum(part[2].shape[0] for part in parts)
+    target = np.empty(num_rows, dtype=np.float64)
+    indptr = np.empty(num_rows + 1, dtype=np.int32 if num_values < np.iinfo(np.int32).max else np.int64)
+    indices = np.empty(num_values, dtype=np.int32)
+    values = implicit_values(num_values, dtype) if implicit_ones else np.empty(num_values, dtype=dtype)
+    indptr[0] = 0
+    if num_buckets is not None and hash_stats is not None:
+        hash_stats.update(get_hash_stats(np.unique(np.concatenate([part[4] for part in parts])), num_buckets))
+    
+    row, nnz = 0, 0
+    while parts:
+        _target, _row_nnz, _ids, _values, _raw_ids = parts.pop(0) # free each part once it is copied
+        end_row, end_nnz = row + _target.shape[0], nnz + _ids.shape[0]
+        target[row:end_row] = _target
+        indptr[row+1:end_row+1] = nnz + np.cumsum(_row_nnz)
+        indices[nnz:end_nnz] = _ids
+        if not implicit_ones:
+            values[nnz:end_nnz] = _values
+        row, nnz = end_row, end_nnz
+    
+    if num_buckets is not None:
+        num_feature = num_buckets
+    else:
+        num_feature = int(indices.max()) + 1 if num_values else 0
+    if num_rows:
+        min_target, max_target = target.min(), target.max()
+    else:
+        min_target, max_target = float("inf"), -float("inf")
+    X = sps.csr_matrix((values, indices, indptr), shape=(num_rows, num_feature))
+    return target, min_target, max_target, num_feature, sum_duplicate_features(X, implicit_ones)
+
+
+def get_x_rows_sqr(X):
+    """ sum_c x_ic^2 for each (non trailing empty) row i of the transposed design matrix X """
+    return np.add.reduceat(X.data*X.data, X.indptr[X.indptr<X.indptr[-1]], dtype=np.float64)
+
+
+def transpose_csr(X, implicit_ones=False):
+    """
+    csr_matrix of the transpose of X. With implicit_ones only the structure is
+    transposed (with a temporary array of 1 byte per value).
+    """
+    if not implicit_ones:
+        return X.transpose().tocsr()
+    X_t = sps.csr_matrix((np.ones(X.nnz, dtype=np.bool_), X.indices, X.indptr), shape=X.shape).transpose().tocsr()
+    return sps.csr_matrix((implicit_values(X.nnz, X.dtype), X_t.indices, X_t.indptr), shape=X_t.shape)
+
+
+def get_segments(X, rows):
+    """
+    Positions in X.data/X.indices of the values of the rows of the csr_matrix X, 
+    concatenated, and the row (index in rows) of each value.
+    """
+    starts = X.indptr[rows]
+    lengths = X.indptr[rows + 1] - starts
+    seg = np.repeat(np.arange(rows.shape[0]), lengths)
+    pos = np.arange(seg.shape[0]) + np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    return pos, seg
+
+
+def color_features(X):
+    """
+    Greedy coloring of the rows (features) of the transposed design matrix X 
+    such that the features of a color never share a case. Returns the
+    non empty features ordered by color and the start of each color in
+    this order.
+    """
+    # bit b of the word w of a case: the color 64*w+b is used by one of its features
+    used = np.zeros((X.shape[1], 1), dtype=np.uint64)
+    colors = np.empty(X.shape[0], dtype=np.int64)
+    colors.fill(-1)
+    for row in xrange(X.shape[0]):
+        start, stop = X.indptr[row], X.indptr[row + 1]
+        if start == stop:
+            continue
+        cols = X.indices[start:stop]
+        free = ~np.bitwise_or.reduce(used[cols], axis=0)
+        words = np.flatnonzero(free)
+        if words.shape[0]:
+            word = words[0]
+            free_word = long(free[word])
+            bit = (free_word & -free_word).bit_length() - 1
+        else:
+            used = np.hstack((used, np.zeros((used.shape[0], 1), dtype=np.uint64)))
+            word, bit = used.shape[1] - 1, 0
+        used[cols, word] |= np.uint64(1 << bit)
+        colors[row] = 64 * word + bit
+    
+    rows = np.flatnonzero(colors >= 0)
+    order = rows[np.argsort(colors[rows], kind='mergesort')]
+    num_colors = colors.max() + 1 if rows.shape[0] else 0
+    color_ptr = np.searchsorted(colors[order], np.arange(num_colors + 1))
+    return order, color_ptr
+
+
+def pad_rows(X, num_rows):
+    """ Add empty rows at the end of the csr_matrix X without copying its data """
+    if X.shape[0] == num_rows:
+        return X
+    indptr = np.concatenate((X.indptr, np.repeat(X.indptr[-1], num_rows - X.shape[0])))
+    return sps.csr_matrix((X.data, X.indices, indptr), shape=(num_rows, X.shape[1]))
+
+####################################
+########### Binary cache ###########
+####################################
+
+CACHE_VERSION = 3
+CACHE_ARRAYS = ['target', 'indptr', 'indices', 'data', 
+                't_indptr', 't_indices', 't_data', 't_data_sqr', 'x_rows_sqr']
+CACHE_VALUES = ['data', 't_data', 't_data_sqr'] # not stored with implicit_ones
+
+def libfm_cache_dir(filename):
+    return filename + '.cache'
+
+
+def is_libfm_cache_valid(filename, cache_dir=None, dtype=np.float64, implicit_ones=False, num_buckets=None):
+    """
+    The cache is valid if it was written by this version of the code from a
+    source file with the same size and modification time, with the same layout
+    of the values (dtype, implicit_ones) and feature hashing (num_buckets).
+    """
+    cache_dir = cache_dir or libfm_cache_dir(filename)
+    try:
+        with open(os.path.join(cache_dir, 'stats.json'), 'r') as f:
+            stats = json.load(f)
+    except (IOError, ValueError):
+        return False
+    source = os.stat(filename)
+    return (stats.get('version') == CACHE_VERSION and 
+            stats.get('source_size') == source.st_size and
+            stats.get('source_mtime') == source.st_mtime and
+            stats.get('dtype') == np.dtype(dtype).name and
+            stats.get('implicit_ones') == implicit_ones and
+            stats.get('num_buckets') == num_buckets and
+            all(os.path.exists(os.path.join(cache_dir, name + '.npy')) for name in stats['arrays']))
+
+
+def convert_libfm(filename, cache_dir=None, chunk_size=1<<24, num_workers=1, dtype=np.float64, implicit_ones=False,
+                  num_buckets=None):
+    """
+    Parse the libFM file once and write the arrays needed by Data (CSR of the
+    file, CSR of its transpose, squared values, target and stats) to cache_dir,
+    one .npy file per array so they can be opened with np.memmap.
+    """
+    cache_dir = cache_dir or libfm_cache_dir(filename)
+    source = os.stat(filename)
+    hash_stats = {}
+    target, min_target, max_target, num_feature, X = read_libfm(filename, chunk_size, num_workers, dtype, implicit_ones,
+                                                                num_buckets, hash_stats)
+    X_t = transpose_csr(X, implicit_ones)
+    
+    arrays = {'target': target, 'indptr': X.indptr, 'indices': X.indices, 'data': X.data,
+              't_indptr': X_t.indptr, 't_indices': X_t.indices, 't_data': X_t.data,
+              't_data_sqr': X_t.data * X_t.data, 'x_rows_sqr': get_x_rows_sqr(X_t)}
+    stats = {'version': CACHE_VERSION, 'source_size': source.st_size, 'source_mtime': source.st_mtime,
+             'num_rows': X.shape[0], 'num_values': X.nnz, 'num_feature': num_feature, 
+             'min_target': min_target, 'max_target': max_target,
+             'dtype': np.dtype(dtype).name, 'implicit_ones': implicit_ones,
+             'num_buckets': num_buckets, 'hash_stats': hash_stats,
+             'arrays': [name for name in CACHE_ARRAYS if not (implicit_ones and name in CACHE_VALUES)]}
+    
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    # stats.json is written last, a partially written cache is never valid
+    if os.path.exists(os.path.join(cache_dir, 'stats.json')):
+        os.remove(os.path.join(cache_dir, 'stats.json'))
+    for name in CACHE_ARRAYS:
+        path = os.path.join(cache_dir, name + '.npy')
+        if name in stats['arrays']:
+            np.save(path, arrays[name])
+        elif os.path.exists(path):
+            os.remove(path)
+    with open(os.path.join(cache_dir, 'stats.json'), 'w') as f:
+        json.dump(stats, f)
+    return cache_dir
+
+
+def load_libfm_cache(cache_dir):
+    """ Open the arrays of the cache as read-only memory maps (no copy) """
+    with open(os.path.join(cache_dir, 'stats.json'), 'r') as f:
+        stats = json.load(f)
+    arrays = {}
+    for name in stats['arrays']:
+        arrays[name] = np.load(os.path.join(cache_dir, name + '.npy'), mmap_mode='r')
+    return stats, arrays
 
 ####################################
 ####################################
 ####################################
  
-class Data:
+class Data(object):
+    """
+    has_x : keep the row-major design matrix X (cases x features)
+    has_xt : keep the per-feature layout (data_t, x_rows_sqr, row_start_stop, tmp) 
+             used by the sampler
+    role : 'train' (== has_x=False, has_xt=True) or 'eval' (== has_x=True, has_xt=False),
+           overrides has_x/has_xt
+    dtype : float dtype of the stored values (np.float32 halves their memory)
+    implicit_ones : for binary features, the values (data and tmp) are not stored at all
+    num_buckets : hash the raw feature ids (e.g. 64 bits hashes) to num_buckets features,
+                  the collision statistics are in hash_stats. Use the same value for
+                  the train and the test sets.
+    
+    Relational blocks (libFM BS format) are attached with add_relation: their
+    features are stored once per block row instead of once per case.
+    
+    The structures are built the first time they are accessed. The row-major X 
+    of a dataset without has_x is freed once data_t is built, and data (the COO
+    matrix) is built on demand and never kept.
+    """
        
-    def __init__(self, filename, has_x, has_xt, max_feature):
+    def __init__(self, filename, has_x, has_xt, max_feature=None, chunk_size=1<<24, 
+                cache=False, cache_dir=None, num_workers=1, dtype=np.float64, implicit_ones=False,
+                role=None, num_buckets=None):
     
+        self._set_layout(filename, has_x, has_xt, implicit_ones, role)
+        self.num_buckets = num_buckets
+        self.hash_stats = {}
+       
+        if cache:
+            # (1) open the binary cache, rebuild it first if it is missing or stale
+            cache_dir = cache_dir or libfm_cache_dir(filename)
+            if not is_libfm_cache_valid(filename, cache_dir, dtype, implicit_ones, num_buckets):
+                convert_libfm(filename, cache_dir, chunk_size, num_workers, dtype, implicit_ones, num_buckets)
+            stats, arrays = load_libfm_cache(cache_dir)
+            self.hash_stats = stats['hash_stats']
+            target, self.min_target, self.max_target = arrays['target'], stats['min_target'], stats['max_target']
+            num_feature = stats['num_feature']
+            if implicit_ones:
+                arrays['data'] = arrays['t_data'] = implicit_values(stats['num_values'], dtype)
+            X = sps.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), 
+                               shape=(stats['num_rows'], num_feature))
+        else:
+            # (1) read the data in a single pass
+            target, self.min_target, self.max_target, num_feature, X = read_libfm(filename, chunk_size, num_workers, 
+                                                                                   dtype, implicit_ones, 
+                                                                                   num_buckets, self.hash_stats)
+            arrays = None
+        if num_buckets is not None:
+            print "num_raw_features=", self.hash_stats['num_raw_features'], "\tnum_used_buckets=", self.hash_stats['num_used_buckets'], "\tnum_collisions=", self.hash_stats['num_collisions'], "\tcollision_rate=", self.hash_stats['collision_rate']
+        self._set_data(target, num_feature, X, max_feature, arrays)
+
+    @classmethod
+    def from_csr(cls, target, X, has_x, has_xt, max_feature=None, implicit_ones=False, role=None, filename=None):
+        """ 
+        Data of a target and a csr_matrix X (num_cases x num_feature) built in memory,
+        the repeated features of a row of X are summed in place
+        """
+        data = cls.__new__(cls)
+        data._set_layout(filename, has_x, has_xt, implicit_ones, role)
+        data.num_buckets, data.hash_stats = None, {}
+        if target.shape[0]:
+            data.min_target, data.max_target = target.min(), target.max()
+        else:
+            data.min_target, data.max_target = float("inf"), -float("inf")
+        data._set_data(target, X.shape[1], sum_duplicate_features(X, implicit_ones), max_feature)
+        return data
+
+    @classmethod
+    def from_categorical(cls, filename, vocabulary, has_x, has_xt, max_feature=None, chunk_size=1<<24,
+                         dtype=np.float64, implicit_ones=False, role=None):
+        """ 
+        Data of a delimited categorical file, encoded with the CategoricalVocabulary
+        vocabulary (which is built by the first file it reads)
+        """
+        target, min_target, max_target, num_feature, X = vocabulary.read(filename, chunk_size, dtype, implicit_ones)
+        return cls.from_csr(target, X, has_x, has_xt, max_feature, implicit_ones, role, filename)
+
+    def _set_layout(self, filename, has_x, has_xt, implicit_ones, role):
+        if role is not None:
+            if role not in ('train', 'eval'):
+                raise Exception('Unknown role')
+            has_x, has_xt = role == 'eval', role == 'train'
         self.filename = filename
+        self.role = role
         self.has_x = has_x #False
         self.has_xt = has_xt #True
-       
-        num_rows = 0
-        num_values = 0
-        num_feature = 0
-        has_feature = False
-        self.min_target = float("inf")
-        self.max_target = -float("inf")
-    
-        # (1) determine the number of rows and the maximum feature_id
-        with open(filename, 'r') as f:
-            for line in f:
-                spl = line.split()
-                _value = float(spl[0])
-                self.min_target = min(_value, self.min_target)
-                self.max_target = max(_value, self.max_target)    
-                num_rows += 1
-                #print spl
-                for i in range(1,len(spl)):
-                    _feature, _value = map(float, spl[i].split(':'))
-                    num_feature = max(_feature, num_feature)
-                    has_feature = True
-                    num_values += 1
-        if has_feature:    
-            num_feature += 1 # number of feature is bigger (by one) than the largest value
+        self.implicit_ones = implicit_ones
+
+    def _set_data(self, target, num_feature, X, max_feature, arrays=None):
+        num_rows, num_values = X.shape[0], X.nnz
         print "num_rows=", num_rows, "\tnum_values=" ,num_values, "\tnum_features=", num_feature, "\tmin_target=", self.min_target, "\tmax_target=", self.max_target
         
+        if max_feature is None:
+            max_feature = num_feature
+        max_feature = int(max_feature)
         assert(num_feature <= max_feature)
         
-        rows    = np.zeros(num_values)
-        cols    = np.zeros(num_values)
-        values  = np.zeros(num_values)
+        self.target_value = target
+        self.num_feature = num_feature
+        self.num_values  = num_values
+        self.num_cases = num_rows 
+        self.relations = []
         
-        self.target_value = np.zeros(num_rows)
+        # (2) the structures are built on their first access
+        self._arrays = arrays # memory mapped cache
+        self._X = X
+        self._X_sqr = None # X with the squared values, built by the first dot_t_sqr of the row-major layout
+        self._data_t = None
+        self._colors = None
+        self.set_num_feature(max_feature)
+        
+    def set_num_feature(self, max_feature):
+        """
+        Set the number of columns of the design matrix, i.e. the number of
+        attributes of the model, which can be larger than the largest feature
+        id of the file (e.g. features only present in the other dataset).
+        """
+        assert(max_feature >= self.num_feature)
         self.num_feature = max_feature
-        self.num_values  = num_values
+        if self._X is not None:
+            self._X = sps.csr_matrix((self._X.data, self._X.indices, self._X.indptr), shape=(self.num_cases, max_feature))
+            self._X_sqr = None
+        if self._data_t is not None:
+            self._data_t = pad_rows(self._data_t, max_feature)
+            self._tmp = pad_rows(self._tmp, max_feature)
+            X = self._data_t
+            self._row_start_stop = as_strided(X.indptr, shape=(self._t_rows, 2), strides=2*X.indptr.strides)
+    
+    def add_relation(self, block, index):
+        """
+        Attach a relational block: block is the Data of a design matrix shared
+        by the cases (its target is ignored) and index the row of block of each
+        case. The features of the blocks come after the num_feature features of
+        the dataset, in the order the blocks are attached.
+        """
+        index = np.asarray(index, dtype=np.int32)
+        if index.shape[0] != self.num_cases:
+            raise ValueError('The relation index has %d rows for %d cases' % (index.shape[0], self.num_cases))
+        if index.shape[0] and (index.min() < 0 or index.max() >= block.num_cases):
+            raise ValueError('The relation index is out of the %d rows of the block' % block.num_cases)
+        self.relations.append((block, index))
+
+    def iter_relations(self):
+        """ (block, index, offset of the block features) of each relational block """
+        offset = self.num_feature
+        for block, index in self.relations:
+            yield block, index, offset
+            offset += block.num_feature
+
+    @property
+    def num_all_feature(self):
+        """ number of features of the dataset and of its relational blocks """
+        return self.num_feature + sum(block.num_feature for block, index in self.relations)
+
+    def _build_t(self):
+        arrays = self._arrays
+        if arrays is None:
+            self._data_t = transpose_csr(self._X, self.implicit_ones)
+            X = self._data_t
+            self._x_rows_sqr = get_x_rows_sqr(X)
+            if not self.implicit_ones:
+                self._tmp = sps.csr_matrix((X.data*X.data, X.indices, X.indptr), shape=X.shape)
+        else:
+            shape = (arrays['t_indptr'].shape[0] - 1, self.num_cases)
+            self._data_t = sps.csr_matrix((arrays['t_data'], arrays['t_indices'], arrays['t_indptr']), shape=shape)
+            self._x_rows_sqr = arrays['x_rows_sqr']
+            if not self.implicit_ones:
+                self._tmp = sps.csr_matrix((arrays['t_data_sqr'], arrays['t_indices'], arrays['t_indptr']), shape=shape)
+        if self.implicit_ones:
+            self._tmp = self._data_t # x^2 == x
+        X = self._data_t
+        self._t_rows, self._t_cols = X.indptr[X.indptr<X.indptr[-1]].shape[0], X.shape[1]
         
-        # (2) read the data   
-        row_id = 0
-        cacheID = 0
-        with open(filename, 'r') as f:
-            for line in f:
-                spl = line.split()
-                assert(row_id < num_rows)
-                self.target_value[row_id] = float(spl[0])
-                
-                for i in range(1,len(spl)):
-                    assert(cacheID < num_values)
-                    _feature, _value = map(float, spl[i].split(':'))
-                    rows[cacheID] = row_id
-                    cols[cacheID] = _feature
-                    values[cacheID] = _value
-                    cacheID += 1
-
-                row_id += 1
-           
-        assert(num_rows == row_id)
-        assert(num_values == cacheID)  
-        
-        self.data = coo_matrix((values,(rows, cols)), shape=(num_rows, max_feature))
-        self.num_cases = num_rows 
+        if not self.has_x and arrays is None:
+            self._X = None # the row-major layout is not needed anymore
+        self.set_num_feature(self.num_feature)
 
-        if has_xt:
-            self.data_t = (self.data.transpose()).tocsr()
+    def _get_t(name):
+        def get(self):
+            if self._data_t is None:
+                self._build_t()
+            return getattr(self, name)
+        return property(get)
+
+    data_t = _get_t('_data_t')
+    tmp = _get_t('_tmp')
+    x_rows_sqr = _get_t('_x_rows_sqr')
+    row_start_stop = _get_t('_row_start_stop')
+    t_rows = _get_t('_t_rows')
+    t_cols = _get_t('_t_cols')
+    del _get_t
+    
+    @property
+    def color_classes(self):
+        """ color_features(data_t): the features ordered by color and the start of each color """
+        if self._colors is None:
+            self._colors = color_features(self.data_t)
+        return self._colors
+
+    @property
+    def X(self):
+        """ row-major csr_matrix of the data (rebuilt from data_t and not kept if it was freed) """
+        if self._X is None:
+            return transpose_csr(self._data_t, self.implicit_ones)
+        return self._X
+
+    @property
+    def data(self):
+        """ coo_matrix of the data, built on each access """
+        return self.X.tocoo()
+
+    def dot_t(self, v):
+        """ 
+        sum_i v_i x_ci for each case c (== v * data_t), relational blocks included.
+        v is (num_feature,) or (k, num_feature) for k products at once.
+        """
+        out = self._dot_t(v[..., :self.num_feature])
+        for block, index, offset in self.iter_relations():
+            out += block.dot_t(v[..., offset:offset + block.num_feature])[..., index]
+        return out
+
+    def dot_t_sqr(self, v):
+        """ sum_i v_i x_ci^2 for each case c (== v * tmp), relational blocks included """
+        out = self._dot_t_sqr(v[..., :self.num_feature])
+        for block, index, offset in self.iter_relations():
+            out += block.dot_t_sqr(v[..., offset:offset + block.num_feature])[..., index]
+        return out
+
+    def _dot_t(self, v):
+        if v.ndim == 2 and self.implicit_ones:
+            return np.array([self._dot_t(v_f) for v_f in v])
+        if self._X is None or (self.has_xt and not self.has_x):
             X = self.data_t
-            self.x_rows_sqr = np.add.reduceat(X.data*X.data, X.indptr[X.indptr<X.indptr[-1]])
-            self.t_rows, self.t_cols = X.indptr[X.indptr<X.indptr[-1]].shape[0], X.shape[1]
-            self.row_start_stop = as_strided(X.indptr, shape=(self.t_rows, 2), strides=2*X.indptr.strides)
-            self.tmp = self.data_t.multiply(self.data_t)
+            if self.implicit_ones:
+                return implicit_dot_t(X, v)
+            return v * X
+        X = self._X
+        if self.implicit_ones:
+            return implicit_dot(X, v)
+        return X.dot(v.T).T
+
+    def _dot_t_sqr(self, v):
+        if self.implicit_ones:
+            return self._dot_t(v)
+        if self._X is None or (self.has_xt and not self.has_x):
+            return v * self.tmp
+        if self._X_sqr is None:
+            X = self._X
+            self._X_sqr = X if np.all(X.data == 1) else sps.csr_matrix((X.data*X.data, X.indices, X.indptr), shape=X.shape)
+        return self._X_sqr.dot(v.T).T
 
 ####################################
 ####################################
 ####################################
 
 class DataMetaInfo:
-    def __init__(self, num_attributes):
-        self.attr_group = np.zeros(num_attributes, dtype=int)
-        self.num_attr_groups = 1
-        self.num_attr_per_group = np.zeros(self.num_attr_groups)
-        self.num_attr_per_group[0] = num_attributes
+    def __init__(self, num_attributes, attr_group=None):
+        num_attributes = int(num_attributes)
+        if attr_group is None:
+            self.attr_group = np.zeros(num_attributes, dtype=np.int32)
+            self.num_attr_groups = 1
+        else:
+            self.attr_group = np.asarray(attr_group, dtype=np.int32)
+            assert(self.attr_group.shape[0] == num_attributes)
+            self.num_attr_groups = int(self.attr_group.max()) + 1 if num_attributes else 1
+        self.num_attr_per_group = np.bincount(self.attr_group, minlength=self.num_attr_groups).astype(float)
+
+    def group_sum(self, x):
+        """
+        Sum of x over the attributes of each group, in a single bincount.
+        x is (num_attributes,) -> (num_attr_groups,) or (k, num_attributes) -> (k, num_attr_groups)
+        """
+        G = self.num_attr_groups
+        if x.ndim == 1:
+            return np.bincount(self.attr_group, weights=x, minlength=G)
+        k = x.shape[0]
+        index = (self.attr_group + G * np.arange(k)[:, None]).ravel()
+        return np.bincount(index, weights=x.ravel(), minlength=k * G).reshape(k, G)
+
+
+def read_relation_index(filename):
+    """
+    Row of the relational block of each case of a libFM BS index file 
+    (<relation>.train, <relation>.test): one row id per line.
+    """
+    with open(filename, 'rb') as f:
+        return np.fromstring(f.read(), dtype=np.int64, sep=' ').astype(np.int32)
+
+
+def load_meta_info(filename, num_attributes):
+    """
+    Attribute groups of a libFM meta file (--meta): line i is the group id
+    of the attribute i.
+    """
+    with open(filename, 'rb') as f:
+        attr_group = np.fromstring(f.read(), dtype=np.int64, sep=' ')
+    if attr_group.shape[0] != num_attributes:
+        raise ValueError('The meta file %s has %d groups for %d attributes' % (filename, attr_group.shape[0], num_attributes))
+    if attr_group.shape[0] and attr_group.min() < 0:
+        raise ValueError('The meta file %s has negative groups' % filename)
+    return DataMetaInfo(num_attributes, attr_group)
 
 ####################################
 ####################################
 ####################################
 
-def get_num_attribute(filename):
-    has_feature = False
+class CategoricalVocabulary:
+    """
+    Field-aware vocabulary of delimited categorical files, one line per case
+    'target<delimiter>value_1<delimiter>...<delimiter>value_n' with a field per column.
+    
+    The first file read (the training set) builds the vocabulary in the same
+    streaming pass that encodes it: the (field, value) pairs seen at least 
+    min_count times are the features, the rarer ones are dropped (oov='drop') 
+    or share one out-of-vocabulary feature per field (oov='shared'). The next 
+    files (e.g. the test set) are encoded with this vocabulary, the unknown
+    values being handled the same way. Empty values are missing values.
+    
+    target_column : index of the target column
+    has_header : the first line gives the names of the columns
+    """
+    def __init__(self, target_column=0, delimiter=',', has_header=False, min_count=1, oov='shared'):
+        if oov not in ('drop', 'shared'):
+            raise Exception('Unknown oov')
+        self.target_column = target_column
+        self.delimiter = delimiter
+        self.has_header = has_header
+        self.min_count = min_count
+        self.oov = oov
+        
+        self.fields = None     # names of the fields
+        self.values = None     # for each field, dict value -> feature id
+        self.oov_ids = None    # for each field, the id of its oov feature (or -1)
+        self.num_feature = 0
+        self.attr_group = None # field of each feature
+        
+    def read(self, filename, chunk_size=1<<24, dtype=np.float64, implicit_ones=False):
+        """
+        Read (and encode) a categorical file in a single pass.
+        Returns (target, min_target, max_target, num_feature, X) like read_libfm
+        """
+        build = self.values is None
+        target = GrowableArray(np.float64)
+        ids = GrowableArray(np.int64) # num_rows x num_fields, row-major, -1 for missing/dropped
+        index = counts = None # while building: for each field, dict value -> provisional id and counts
+        num_columns, header = None, self.has_header
+        
+        with open_libfm(filename) as f:
+            for block in iter_libfm_blocks(f, chunk_size):
+                lines = [line.rstrip('\r') for line in block.split('\n') if line.strip()]
+                if header and lines:
+                    names, lines, header = lines[0].split(self.delimiter), lines[1:], False
+                    if build:
+                        self.fields = [name for j, name in enumerate(names) if j != self.target_column % len(names)]
+                if not lines:
+                    continue
+                cells = [line.split(self.delimiter) for line in lines]
+                if num_columns is None:
+                    num_columns = len(cells[0])
+                    target_column = self.target_column % num_columns
+                    if build and self.fields is None:
+                        self.fields = ['field_%d' % j for j in xrange(num_columns - 1)]
+                    if build:
+                        index, counts = [{} for j in xrange(num_columns - 1)], [np.zeros(0, dtype=np.int64) for j in xrange(num_columns - 1)]
+                    if num_columns - 1 != len(self.fields):
+                        raise ValueError('Malformed categorical data: expected %d fields' % len(self.fields))
+                if any(len(row) != num_columns for row in cells):
+                    raise ValueError('Malformed categorical data: expected %d columns' % num_columns)
+                
+                columns = zip(*cells)
+                target.extend(np.array(columns[target_column], dtype=np.float64))
+                block_ids = np.empty((len(cells), num_columns - 1), dtype=np.int64)
+                for field, column in enumerate(columns[:target_column] + columns[target_column+1:]):
+                    # only the distinct values of the block are looked up in the dicts
+                    uniq, inverse, uniq_counts = np.unique(np.array(column), return_inverse=True, return_counts=True)
+                    if build:
+                        uniq_ids = np.array([index[field].setdefault(value, len(index[field])) if value else -1 
+                                             for value in uniq], dtype=np.int64)
+                        if counts[field].shape[0] < len(index[field]):
+                            counts[field] = np.concatenate((counts[field], np.zeros(len(index[field]) - counts[field].shape[0], dtype=np.int64)))
+                        present = uniq_ids >= 0
+                        counts[field][uniq_ids[present]] += uniq_counts[present]
+                    else:
+                        uniq_ids = np.array([self.values[field].get(value, self.oov_ids[field]) if value else -1 
+                                             for value in uniq], dtype=np.int64)
+                    block_ids[:, field] = uniq_ids[inverse]
+                ids.extend(block_ids.ravel())
+        
+        if build and index is None:
+            raise ValueError('The categorical file %s has no data to build the vocabulary' % filename)
+        target = target.view()
+        ids = ids.view().reshape(target.shape[0], len(self.fields))
+        if build:
+            ids = self._build(index, counts, ids)
+        
+        valid = ids >= 0
+        indptr = np.concatenate(([0], np.cumsum(valid.sum(axis=1)))).astype(np.int32)
+        indices = ids[valid].astype(np.int32)
+        values = implicit_values(indices.shape[0], dtype) if implicit_ones else np.ones(indices.shape[0], dtype=dtype)
+        if target.shape[0]:
+            min_target, max_target = target.min(), target.max()
+        else:
+            min_target, max_target = float("inf"), -float("inf")
+        X = sps.csr_matrix((values, indices, indptr), shape=(target.shape[0], self.num_feature))
+        return target, min_target, max_target, self.num_feature, X
+    
+    def _build(self, index, counts, ids):
+        """ Prune the values rarer than min_count, number the features field by field and encode ids """
+        self.values, self.oov_ids, attr_group = [], [], []
+        num_feature = 0
+        for field in xrange(len(self.fields)):
+            values = sorted(index[field].items(), key=lambda item: item[1]) # order of first appearance
+            keep = counts[field] >= self.min_count
+            new_ids = np.cumsum(keep) - 1 + num_feature
+            self.values.append(dict((value, new_ids[pid]) for value, pid in values if keep[pid]))
+            num_feature += int(np.sum(keep))
+            if self.oov == 'shared' and not keep.all():
+                oov_id = num_feature
+                num_feature += 1
+            else:
+                oov_id = -1
+            self.oov_ids.append(oov_id)
+            new_ids[~keep] = oov_id
+            
+            column = ids[:, field]
+            present = column >= 0
+            column[present] = new_ids[column[present]]
+            attr_group.extend([field] * (num_feature - len(attr_group)))
+        
+        self.num_feature = num_feature
+        self.attr_group = np.array(attr_group, dtype=int)
+        print "num_fields=", len(self.fields), "\tnum_values=", sum(len(index_f) for index_f in index), "\tnum_kept_values=", sum(len(values) for values in self.values), "\tnum_features=", num_feature
+        return ids
+    
+    def meta_info(self):
+        """ DataMetaInfo with one attribute group per field (the fields without any feature have no group) """
+        groups, attr_group = np.unique(self.attr_group, return_inverse=True)
+        return DataMetaInfo(self.num_feature, attr_group)
+
+####################################
+####################################
+####################################
+
+def get_num_attribute(filename, chunk_size=1<<24):
     num_feature = 0
-    with open(filename, 'r') as f:
-        for line in f:
-            spl = line.split()
-            for i in range(1,len(spl)):
-                _feature, _value = map(float, spl[i].split(':'))
-                num_feature = max(_feature, num_feature)
-                has_feature = True
-    if has_feature:    
-        num_feature += 1 # number of feature is bigger (by one) than the largest value
+    with open_libfm(filename) as f:
+        for block in iter_libfm_blocks(f, chunk_size):
+            _target, _row_nnz, _ids, _values = parse_libfm_block(block)
+            if _ids.shape[0]:
+                num_feature = max(num_feature, int(_ids.max()) + 1) # number of feature is bigger (by one) than the largest value
     return num_feature
     
              
@@ -692,6 +2704,28 @@ def main():
     parser.add_argument("-burn", type=int, 
                     default=0,
                     help="Burn-in; default=0")
+    parser.add_argument("-eval_every", type=int, 
+                    default=1,
+                    help="Print the errors every eval_every iterations, 0 for the last one only; default=1")
+    parser.add_argument("-eval_sample", type=int, 
+                    default=None,
+                    help="Compute the errors on eval_sample random train and test cases; default=None (all)")
+    parser.add_argument("-tol", type=float, 
+                    default=0.0,
+                    help="Stop when the relative change of the RMSE stays below tol "+
+                         "for patience evaluations; default=0 (never)")
+    parser.add_argument("-patience", type=int, 
+                    default=1,
+                    help="Evaluations below tol before stopping; default=1")
+    parser.add_argument("-time_budget", type=float, 
+                    default=None,
+                    help="Stop after the iteration which exceeds time_budget seconds; default=None")
+    parser.add_argument("-thin", type=int, 
+                    default=1,
+                    help="Keep one sample every thin after the burn-in; default=1")
+    parser.add_argument("-pred_var", action='store_true',
+                    help="MCMC: also write the variance of the predictions of the kept samples to "+
+                         "output_var.csv (single chain)")
     parser.add_argument("-learn_rate", type=float, 
                     default=0.1,
                     help="learn_rate for SGD; default=0.1")
@@ -700,30 +2734,181 @@ def main():
                     help="Standard deviation for initialization of 2-way factors."+
                          "Defaults to 0.01.")
     
+    parser.add_argument("-colored", action='store_true',
+                    help="Draw the features which never share a train case together "+
+                         "(greedy coloring of the train features)")
+    parser.add_argument("-num_threads", type=int, 
+                    default=1,
+                    help="Draw the features of a color in parallel blocks (implies -colored), "+
+                         "concurrently with -backend numba only; default=1")
+    parser.add_argument("-q_cache", action='store_true',
+                    help="Keep the q-terms of the train cases for all the factors up to date")
+    parser.add_argument("-q_cache_limit_mb", type=float, 
+                    default=None,
+                    help="Memory of the q cache, the other factors are recomputed; default=None (no limit)")
+    parser.add_argument("-resync", type=int, 
+                    default=0,
+                    help="Recompute the train predictions every resync iterations; default=0 (never)")
+    parser.add_argument("-joint", action='store_true',
+                    help="Draw the k factors of each feature together (block Gibbs / block ALS)")
+    parser.add_argument("-backend", type=str, choices=['numpy', 'numba', 'auto'],
+                    default='numpy',
+                    help="Kernels of the per-feature loops of the sequential and colored sweeps "+
+                         "(numba: compiled, run without the GIL by -num_threads); default=numpy")
+    parser.add_argument("-model_dtype", type=str, choices=['float64', 'float32'],
+                    default='float64',
+                    help="dtype of the model (w, v) and of the e/q caches; default=float64")
+    parser.add_argument("-jacobi", action='store_true',
+                    help="ALS: update all the features at once (damped), one after the other when "+
+                         "the loss increases")
+    parser.add_argument("-damping", type=float, 
+                    default=0.5,
+                    help="Damping of the Jacobi updates; default=0.5")
+    parser.add_argument("-active_set", action='store_true',
+                    help="ALS: skip the features whose updates are below active_tol, "+
+                         "all the features are swept every full_sweep iterations")
+    parser.add_argument("-active_tol", type=float, 
+                    default=1e-6,
+                    help="Tolerance of the active set; default=1e-6")
+    parser.add_argument("-full_sweep", type=int, 
+                    default=10,
+                    help="Iterations between the full sweeps of the active set; default=10")
+    parser.add_argument("-meta", type=str, 
+                    default=None,
+                    help="libfm meta file, the group id of each attribute; default=None (one group)")
+    parser.add_argument("-relation", type=str, 
+                    default=None,
+                    help="BS: comma separated relational blocks, each one read from data/<name>.x "+
+                         "(libfm file of the block) and data/<name>.train, data/<name>.test "+
+                         "(block row of each case); default=None")
     parser.add_argument("-train", type=str, 
                     help="libfm train file; MANDATORY") #Force this parameter
     parser.add_argument("-test", type=str,
                     help="libfm test file; MANDATORY") #Force this parameter
+    parser.add_argument("-cache", action='store_true',
+                    help="Convert the train/test files once to a binary cache (<file>.cache) "+
+                         "and memory map it on the next runs")
+    parser.add_argument("-parse_workers", type=int, 
+                    default=1,
+                    help="Number of processes parsing the train/test files; default=1")
+    parser.add_argument("-data_dtype", type=str, choices=['float64', 'float32'],
+                    default='float64',
+                    help="dtype of the stored feature values; default=float64")
+    parser.add_argument("-implicit_ones", action='store_true',
+                    help="Binary features: do not store the feature values at all")
+    parser.add_argument("-categorical", action='store_true',
+                    help="The train/test files are delimited categorical columns 'target,value,...'"+
+                         " instead of libfm files")
+    parser.add_argument("-delimiter", type=str, 
+                    default=',',
+                    help="Delimiter of the categorical files; default=','")
+    parser.add_argument("-min_count", type=int, 
+                    default=1,
+                    help="Categorical values seen less often in the train file go to a per field "+
+                         "out-of-vocabulary feature; default=1")
+    parser.add_argument("-hash_buckets", type=int, 
+                    default=None,
+                    help="Hash the raw feature ids to this number of features; default=None (no hashing)")
+    parser.add_argument("-chains", type=int, 
+                    default=1,
+                    help="MCMC: run this number of independent chains and pool their predictions; default=1")
+    parser.add_argument("-chain_workers", type=int, 
+                    default=1,
+                    help="Number of processes running the chains; default=1")
+    parser.add_argument("-shards", type=int, 
+                    default=1,
+                    help="MCMC: consensus MCMC over this number of row shards of the train set; default=1")
+    parser.add_argument("-shard_address", type=str, 
+                    default='localhost:0',
+                    help="host:port the consensus coordinator listens on (port 0: any free port, "+
+                         "only with the local workers); default=localhost:0")
+    parser.add_argument("-remote_workers", action='store_true',
+                    help="Wait for the consensus workers (-shard_worker) instead of starting local ones")
+    parser.add_argument("-shard_worker", type=str, 
+                    default=None,
+                    help="Run a consensus worker connecting to the coordinator at host:port and exit")
+    parser.add_argument("-shard_authkey", type=str, 
+                    default=None,
+                    help="Secret of the consensus connections, required for remote workers or a "+
+                         "non loopback address (visible in ps, prefer the %s environment variable)" 
+                         % CONSENSUS_AUTHKEY_ENV)
     args = parser.parse_args()
+    
+    if args.shard_worker:
+        host, port = args.shard_worker.rsplit(':', 1)
+        consensus_worker((host, int(port)), args.shard_authkey)
+        return
+    if args.shards > 1 and args.remote_workers and int(args.shard_address.rsplit(':', 1)[1]) == 0:
+        raise Exception('The remote workers need the port of the coordinator, set it in -shard_address')
+    if args.pred_var and (args.method != 'mcmc' or args.chains > 1 or args.shards > 1):
+        raise Exception('-pred_var is for a single MCMC chain')
 
 
 
     train_file = 'data/train.libfm' #'data/small_train.libfm'
     test_file = 'data/test.libfm' #'data/small_test.libfm''
     
-    num_all_attribute = max(get_num_attribute(train_file), get_num_attribute(test_file))
+    if args.categorical:
+        vocabulary = CategoricalVocabulary(delimiter=args.delimiter, min_count=args.min_count)
+        data_kwargs = {'dtype': np.dtype(args.data_dtype), 'implicit_ones': args.implicit_ones}
+        train = Data.from_categorical(train_file, vocabulary, False, True, role='train', **data_kwargs)
+        test = Data.from_categorical(test_file, vocabulary, True, False, role='eval', **data_kwargs)
+        num_all_attribute = vocabulary.num_feature
+        meta = vocabulary.meta_info()
+    else:
+        data_kwargs = {'cache': args.cache, 'num_workers': args.parse_workers, 
+                       'dtype': np.dtype(args.data_dtype), 'implicit_ones': args.implicit_ones, 
+                       'num_buckets': args.hash_buckets}
+        train = Data(train_file, False, True, role='train', **data_kwargs)
+        test = Data(test_file, True, False, role='eval', **data_kwargs)
+        
+        num_all_attribute = max(train.num_feature, test.num_feature)
+        train.set_num_feature(num_all_attribute)
+        test.set_num_feature(num_all_attribute)
+        if args.relation:
+            del data_kwargs['num_buckets']
+            for name in args.relation.split(','):
+                block = Data('data/%s.x' % name, False, True, role='train', **data_kwargs)
+                train.add_relation(block, read_relation_index('data/%s.train' % name))
+                test.add_relation(block, read_relation_index('data/%s.test' % name))
+            num_all_attribute = train.num_all_feature
+        if args.meta:
+            meta = load_meta_info(args.meta, num_all_attribute)
+        else:
+            meta = DataMetaInfo(num_all_attribute)
+    fm_kwargs = dict(num_iter=args.iteration, dim=args.dim, dtype=np.dtype(args.model_dtype))
+    mcmc_kwargs = dict(colored=args.colored,
+                      num_threads=args.num_threads, q_cache=args.q_cache,
+                      q_cache_limit=None if args.q_cache_limit_mb is None else args.q_cache_limit_mb * (1<<20),
+                      resync=args.resync, joint=args.joint, backend=args.backend,
+                      jacobi=args.jacobi, damping=args.damping, active_set=args.active_set,
+                      active_tol=args.active_tol, full_sweep=args.full_sweep, thin=args.thin,
+                      eval_every=args.eval_every, eval_sample=args.eval_sample, tol=args.tol,
+                      patience=args.patience, time_budget=args.time_budget)
     
-    train = Data(train_file, False, True, num_all_attribute)
-    test = Data(test_file, False, True, num_all_attribute)
+    if args.shards > 1:
+        if args.method != 'mcmc':
+            raise Exception('The consensus is for MCMC')
+        host, port = args.shard_address.rsplit(':', 1)
+        pred, draws = run_consensus(train, test, args.shards, args.burn, args.seed, fm_kwargs, (host, int(port)),
+                                    args.shard_authkey, local_workers=not args.remote_workers, **mcmc_kwargs)
+        np.savetxt('output.csv', pred, delimiter=",", fmt='%.10f')
+        return
     
-    assert(num_all_attribute == max(train.num_feature, test.num_feature))
+    if args.chains > 1:
+        if args.method != 'mcmc':
+            raise Exception('The chains are for MCMC')
+        pred, r_hat, chains = run_chains(meta, train, test, args.burn, args.chains, args.chain_workers, 
+                                         args.seed, fm_kwargs, **mcmc_kwargs)
+        print 'Chains:', args.chains, '\tmax R-hat=', np.nanmax(r_hat), '\tmean R-hat=', np.nanmean(r_hat)
+        np.savetxt('output.csv', pred, delimiter=",", fmt='%.10f')
+        return
     
-    meta = DataMetaInfo(num_all_attribute)
-    fm = libFM(num_all_attribute, seed=args.seed, method=args.method, num_iter=args.iteration,
-                dim=args.dim)
-
-    mcmc = MCMC_learn(fm, meta, train, test, burn=args.burn)
+    fm = libFM(num_all_attribute, seed=args.seed, method=args.method, **fm_kwargs)
+    mcmc = MCMC_learn(fm, meta, train, test, burn=args.burn, pred_var=args.pred_var, **mcmc_kwargs)
     mcmc.learn()
+    if args.pred_var:
+        np.savetxt('output_var.csv', mcmc.posterior.var(), delimiter=",", fmt='%.10f')
 
 #cProfile.run('main()','script_perf')
 #perf = Stats('script_perf').sort_stats('time', 'calls').print_stats(20)
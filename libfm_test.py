@@ -7,6 +7,29 @@ from libfm_sparse_v2 import DataMetaInfo
 from libfm_sparse_v2 import Data 
 from libfm_sparse_v2 import libFM
 from libfm_sparse_v2 import MCMC_learn
+from libfm_sparse_v2 import read_libfm
+from libfm_sparse_v2 import read_libfm_parallel
+from libfm_sparse_v2 import get_num_attribute
+from libfm_sparse_v2 import is_libfm_cache_valid
+from libfm_sparse_v2 import get_compression
+from libfm_sparse_v2 import hash_features
+from libfm_sparse_v2 import parse_libfm_block
+from libfm_sparse_v2 import CategoricalVocabulary
+from libfm_sparse_v2 import load_meta_info
+from libfm_sparse_v2 import get_kernels
+from libfm_sparse_v2 import RunningMean
+from libfm_sparse_v2 import implicit_values
+from libfm_sparse_v2 import run_chains
+from libfm_sparse_v2 import run_consensus
+from libfm_sparse_v2 import consensus_draws
+from libfm_sparse_v2 import numba
+import libfm_sparse_v2
+import bz2
+import gzip
+import os
+import shutil
+import tempfile
+import threading
 import unittest
 
 class Initialisation():
@@ -32,6 +55,16 @@ class Initialisation():
 
         self.train = Data(train_file, False, True, self.num_all_attribute)
         self.test = Data(test_file, False, True, self.num_all_attribute)
+
+class RandomRegression():
+    """ random sparse linear regression, the train set is also the test set """
+    def __init__(self, num_cases=200, num_feature=30, dtype=np.float64):
+        rng = np.random.RandomState(4)
+        X = sps.csr_matrix(rng.rand(num_cases, num_feature) * (rng.rand(num_cases, num_feature) < 0.2))
+        self.target = X.dot(rng.randn(num_feature)) + 3 + 0.1 * rng.randn(num_cases)
+        self.X = X.astype(dtype)
+        self.train = Data.from_csr(self.target, self.X, False, True, role='train')
+        self.test = Data.from_csr(self.target, self.X, True, False, role='eval')
         
 
 # Here's our "unit tests".
@@ -44,6 +77,664 @@ class DataTests(unittest.TestCase):
         self.assertTrue((init.train.data.row == [ 0,0,1,1,2,2,3,3,4,4,5,5,6,6,7,7,8,8,9,9,10,10,11,11,12,12,13,13,14,14]).all() )
         self.assertTrue((init.train.data.data == [1.]*30 ).all() )
     
+    def test_read_libfm(self):
+        fd, filename = tempfile.mkstemp(suffix='.libfm')
+        with os.fdopen(fd, 'w') as f:
+            f.write('1.5 3:0.5 10:2\n\n-2 0:1\n4\n3 7:1e-1 2:3')
+        try:
+            for chunk_size in [1, 5, 1<<20]:
+                target, min_target, max_target, num_feature, X = read_libfm(filename, chunk_size)
+                self.assertTrue((target == [1.5, -2, 4, 3]).all())
+                self.assertEqual((min_target, max_target, num_feature), (-2, 4, 11))
+                self.assertTrue((X.indptr == [0, 2, 3, 3, 5]).all())
+                self.assertTrue((X.indices == [3, 10, 0, 2, 7]).all())
+                self.assertTrue((X.data == [0.5, 2, 1, 3, 0.1]).all())
+            self.assertEqual(get_num_attribute(filename, 5), 11)
+            
+            with open(filename, 'w') as f:
+                f.write('1 3:0.5 4\n')
+            self.assertRaises(ValueError, read_libfm, filename)
+            
+            # the ids which do not fit in the int32 indices need hashing
+            with open(filename, 'w') as f:
+                f.write('1 3000000000:1\n2 3:1\n')
+            self.assertRaises(ValueError, read_libfm, filename)
+            self.assertRaises(ValueError, read_libfm, filename, num_workers=2)
+            self.assertEqual(read_libfm(filename, num_buckets=16)[3], 16)
+            
+            # a feature repeated in a row is a single value, the e-terms agree with the predictions
+            with open(filename, 'w') as f:
+                f.write('1 3:1 3:1 1:1\n2 1:1 0:2\n0.5 3:0.5 0:1 3:1\n')
+            for num_workers in [1, 2]:
+                X = read_libfm(filename, num_workers=num_workers)[4]
+                self.assertTrue((X.indptr == [0, 2, 4, 6]).all() and (X.indices == [1, 3, 0, 1, 0, 3]).all())
+                self.assertTrue((X.data == [1, 2, 2, 1, 1, 1.5]).all())
+            train = Data(filename, False, True, role='train')
+            test = Data(filename, False, True, role='eval')
+            fm = libFM(4, seed=1, method='als', num_iter=5, dim='1,1,2', param_regular='0,0,0.1', init_stdev=0.1)
+            fm.save = False
+            mcmc = MCMC_learn(fm, DataMetaInfo(4), train, test, 0)
+            mcmc.learn()
+            np.testing.assert_array_almost_equal(mcmc.cache[0] + train.target_value, libfm_sparse_v2.predict_fm(fm, test))
+        finally:
+            os.remove(filename)
+    
+    def test_read_libfm_parallel(self):
+        fd, filename = tempfile.mkstemp(suffix='.libfm')
+        rng = np.random.RandomState(0)
+        with os.fdopen(fd, 'w') as f:
+            for row in xrange(200):
+                ids = rng.choice(50, rng.randint(0, 6), replace=False)
+                f.write(' '.join(['%d' % rng.randint(-3, 8)] + ['%d:%g' % (i, rng.rand()) for i in ids]) + '\n')
+        try:
+            ref = read_libfm(filename)
+            for num_workers in [2, 3, 7]:
+                out = read_libfm_parallel(filename, num_workers, chunk_size=64)
+                self.assertEqual(out[1:4], ref[1:4])
+                self.assertTrue((out[0] == ref[0]).all())
+                X, X_ref = out[4], ref[4]
+                self.assertEqual(X.shape, X_ref.shape)
+                self.assertTrue((X.indptr == X_ref.indptr).all() and (X.indices == X_ref.indices).all())
+                self.assertTrue((X.data == X_ref.data).all())
+        finally:
+            os.remove(filename)
+    
+    def test_compressed_input(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            with open('data/small_train.libfm', 'rb') as f:
+                content = f.read()
+            ref = Data('data/small_train.libfm', False, True)
+            files = [(os.path.join(tmp_dir, 'train.libfm.gz'), gzip.GzipFile, 'gzip'),
+                     (os.path.join(tmp_dir, 'train.libfm.bz2'), bz2.BZ2File, 'bz2'),
+                     (os.path.join(tmp_dir, 'train_gz.libfm'), gzip.GzipFile, 'gzip')] # found with the magic bytes
+            for filename, open_file, codec in files:
+                f = open_file(filename, 'wb')
+                f.write(content)
+                f.close()
+                self.assertEqual(get_compression(filename), codec)
+                self.assertEqual(get_num_attribute(filename), 9)
+                train = Data(filename, False, True, chunk_size=7)
+                self.assertTrue((train.target_value == ref.target_value).all())
+                self.assertTrue((train.data.row == ref.data.row).all() and (train.data.col == ref.data.col).all())
+                self.assertTrue((train.data.data == ref.data.data).all())
+            self.assertEqual(get_compression('data/small_train.libfm'), None)
+        finally:
+            shutil.rmtree(tmp_dir)
+    
+    def test_compact_dtypes(self):
+        def run_als(train, test):
+            fm = libFM(9, seed=1, method='als', num_iter=5, dim='1,1,3', param_regular='0,0,0.1', init_stdev=0.1)
+            fm.save = False
+            mcmc = MCMC_learn(fm, DataMetaInfo(9), train, test, 0)
+            mcmc.learn()
+            return mcmc.predict()
+        
+        ref = run_als(Data('data/small_train.libfm', False, True, 9), Data('data/small_test.libfm', False, True, 9))
+        for kwargs in [{'dtype': np.float32}, {'implicit_ones': True}, {'dtype': np.float32, 'implicit_ones': True}]:
+            train = Data('data/small_train.libfm', False, True, 9, **kwargs)
+            test = Data('data/small_test.libfm', False, True, 9, **kwargs)
+            self.assertEqual(train.data_t.dtype, kwargs.get('dtype', np.float64))
+            self.assertEqual(train.data_t.indices.dtype, np.int32)
+            if kwargs.get('implicit_ones'):
+                self.assertEqual(train.data_t.data.strides, (0,)) # no memory for the values
+                self.assertTrue(train.tmp is train.data_t)
+            np.testing.assert_array_almost_equal(run_als(train, test), ref, decimal=5)
+        
+        fd, filename = tempfile.mkstemp(suffix='.libfm')
+        with os.fdopen(fd, 'w') as f:
+            f.write('1 3:0.5\n')
+        try:
+            self.assertRaises(ValueError, Data, filename, False, True, implicit_ones=True)
+        finally:
+            os.remove(filename)
+        
+        # the products of the implicit ones are computed by chunks of rows
+        rng = np.random.RandomState(0)
+        X = sps.random(300, 40, density=0.1, format='csr', random_state=rng)
+        X.data[:] = 1
+        v = rng.randn(2, 40)
+        chunk_size = libfm_sparse_v2.IMPLICIT_CHUNK_SIZE
+        for size in [1, 7, chunk_size]:
+            libfm_sparse_v2.IMPLICIT_CHUNK_SIZE = size
+            try:
+                for role in ['train', 'eval']:
+                    data = Data.from_csr(np.zeros(300), X, False, True, implicit_ones=True, role=role)
+                    np.testing.assert_array_almost_equal(data.dot_t(v), X.dot(v.T).T)
+                    np.testing.assert_array_almost_equal(data.dot_t_sqr(v[0]), X.dot(v[0]))
+            finally:
+                libfm_sparse_v2.IMPLICIT_CHUNK_SIZE = chunk_size
+        
+        # their peak memory is the one of a chunk, not of a value per nonzero
+        def peak_memory(f, *args):
+            with open('/proc/self/clear_refs', 'w') as refs:
+                refs.write('5') # reset the peak resident memory (VmHWM)
+            status = lambda: dict(line.split(':') for line in open('/proc/self/status'))
+            rss = int(status()['VmRSS'].split()[0])
+            f(*args)
+            return (int(status()['VmHWM'].split()[0]) - rss) * 1024
+        
+        num_cases, nnz = 250000, 20 # a float64 per nonzero takes 40MB, always mapped (and unmapped) by malloc
+        X = sps.csr_matrix((implicit_values(num_cases * nnz), rng.randint(1000, size=num_cases * nnz).astype(np.int32),
+                            np.arange(0, num_cases * nnz + 1, nnz).astype(np.int32)), shape=(num_cases, 1000))
+        train = Data.from_csr(np.zeros(num_cases), X, False, True, implicit_ones=True, role='train')
+        test = Data.from_csr(np.zeros(num_cases), X, False, True, implicit_ones=True, role='eval')
+        train.data_t
+        v = rng.randn(1000)
+        libfm_sparse_v2.IMPLICIT_CHUNK_SIZE = 1 << 16
+        try:
+            peaks = [peak_memory(data.dot_t, v) for data in [train, test]]
+        except IOError:
+            return # no /proc/self/clear_refs
+        finally:
+            libfm_sparse_v2.IMPLICIT_CHUNK_SIZE = chunk_size
+        for peak in peaks:
+            self.assertLess(peak, 2 * num_cases * nnz) # the arrays of a value per nonzero take 8 bytes per nonzero
+    
+    def test_roles(self):
+        init = Initialisation()
+        train = Data('data/small_train.libfm', False, True, role='train')
+        test = Data('data/small_test.libfm', False, True, role='eval')
+        train.set_num_feature(9)
+        test.set_num_feature(9)
+        self.assertTrue(train._data_t is None and test._data_t is None) # nothing built yet
+        
+        preds = []
+        for train, test in [(init.train, init.test), (train, test)]:
+            fm = libFM(9, seed=1, method='als', num_iter=3, dim='1,1,3', param_regular='0,0,0.1', init_stdev=0.1)
+            fm.save = False
+            mcmc = MCMC_learn(fm, DataMetaInfo(9), train, test, 0)
+            mcmc.learn()
+            preds.append(mcmc.predict())
+        np.testing.assert_array_almost_equal(preds[0], preds[1], decimal=10)
+        
+        self.assertTrue(train._X is None) # the row-major layout is freed once data_t is built
+        self.assertTrue(test._data_t is None) # the eval set only uses the row-major layout
+        self.assertTrue(test._X_sqr is test._X) # binary values: x^2 == x
+        self.assertEqual(train.data_t.shape, (9, 15))
+        self.assertTrue((train.data.col == init.train.data.col).all())
+        self.assertTrue((test.data_t.indices == init.test.data_t.indices).all())
+    
+    def test_feature_hashing(self):
+        raw = np.array([18446744073709551615, 9007199254740993, 9007199254740992, 7, 123456789012345], dtype=np.uint64)
+        buckets = hash_features(raw, 1000)
+        self.assertTrue(((buckets >= 0) & (buckets < 1000)).all())
+        # the two ids which are equal as float64 are still different features
+        self.assertNotEqual(hash_features(raw[1:2], 1<<30)[0], hash_features(raw[2:3], 1<<30)[0])
+        # the raw ids are read exactly from their digits
+        block = '1 %d:1 %d:0.5\n\n-2\t%d:3\r\n0 %d:1 %d:2' % tuple(raw)
+        self.assertTrue((parse_libfm_block(block, True)[2] == raw).all())
+        self.assertRaises(ValueError, parse_libfm_block, '1 x1:1', True)
+        self.assertRaises(ValueError, parse_libfm_block, '1 184467440737095516150:1', True)
+        
+        fd, filename = tempfile.mkstemp(suffix='.libfm')
+        with os.fdopen(fd, 'w') as f:
+            for i in xrange(60):
+                f.write('%d %d:1 %d:0.5\n' % (i % 5, raw[i % 5], raw[(i + 1) % 5]))
+        try:
+            train = Data(filename, False, True, role='train', num_buckets=4)
+            hash_stats = {}
+            read_libfm(filename, chunk_size=64, num_buckets=4, hash_stats=hash_stats)
+            self.assertEqual(hash_stats, train.hash_stats)
+            self.assertEqual(train.num_feature, 4)
+            self.assertEqual(train.hash_stats['num_raw_features'], 5)
+            used = np.unique(hash_features(raw, 4)).shape[0]
+            self.assertEqual(train.hash_stats['num_used_buckets'], used)
+            self.assertEqual(train.hash_stats['num_collisions'], 5 - used)
+            self.assertTrue((train.data.col[train.data.row == 0] == np.unique(hash_features(raw[:2], 4))).all())
+            
+            test = Data(filename, False, True, role='eval', num_buckets=4, num_workers=3)
+            self.assertEqual(test.hash_stats, train.hash_stats)
+            self.assertTrue((test.data.col == train.data.col).all())
+            
+            # the raw ids 0, 2 and 3 share the bucket 0 and 1, 9 the bucket 1: their values are summed
+            with open(filename, 'w') as f:
+                f.write('1 0:1 2:1 1:1\n2 3:0.5 9:1 1:2\n0 2:1\n4 1:1 0:1 3:1 9:1\n')
+            self.assertTrue((hash_features(np.array([0, 1, 2, 3, 9], dtype=np.uint64), 2) == [0, 1, 0, 0, 1]).all())
+            for kwargs in [{}, {'num_workers': 2}, {'cache': True}, {'cache': True}]: # the second one reads the cache
+                train = Data(filename, False, True, role='train', num_buckets=2, **kwargs)
+                test = Data(filename, False, True, role='eval', num_buckets=2, **kwargs)
+                self.assertTrue((train.X.indptr == [0, 2, 4, 5, 7]).all() and (train.X.indices == [0, 1] * 2 + [0] + [0, 1]).all())
+                self.assertTrue((train.X.data == [2, 1, 0.5, 3, 1, 2, 2]).all())
+                fm = libFM(2, seed=1, method='als', num_iter=5, dim='1,1,2', param_regular='0,0,0.1', init_stdev=0.1)
+                fm.save = False
+                mcmc = MCMC_learn(fm, DataMetaInfo(2), train, test, 0)
+                mcmc.learn()
+                np.testing.assert_array_almost_equal(mcmc.cache[0] + train.target_value, 
+                                                     libfm_sparse_v2.predict_fm(fm, test))
+            self.assertTrue(is_libfm_cache_valid(filename, num_buckets=2))
+            self.assertRaises(ValueError, read_libfm, filename, num_buckets=1<<31)
+            self.assertRaises(ValueError, read_libfm, filename, num_buckets=0)
+        finally:
+            os.remove(filename)
+            shutil.rmtree(filename + '.cache', ignore_errors=True)
+        
+        # from_csr (and the categorical data) sums the repeated features as well
+        X = sps.csr_matrix((np.ones(3), [1, 1, 0], [0, 2, 3]), shape=(2, 2))
+        train = Data.from_csr(np.zeros(2), X, False, True, role='train')
+        self.assertTrue((train.data_t.toarray() == [[0, 1], [2, 0]]).all())
+    
+    def test_categorical(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            train_file, test_file = os.path.join(tmp_dir, 'train.csv'), os.path.join(tmp_dir, 'test.csv')
+            with open(train_file, 'w') as f:
+                f.write('user;rating;item\n' + 'a;5;x\nb;3;x\na;1;y\nc;2;\n' * 3 + 'd;4;z\n')
+            with open(test_file, 'w') as f:
+                f.write('user;rating;item\na;4;z\ne;2;y\n')
+            
+            for chunk_size in [4, 1<<20]:
+                vocabulary = CategoricalVocabulary(target_column=1, delimiter=';', has_header=True, min_count=2)
+                train = Data.from_categorical(train_file, vocabulary, False, True, role='train', chunk_size=chunk_size)
+                test = Data.from_categorical(test_file, vocabulary, False, True, role='eval', chunk_size=chunk_size)
+                self.assertEqual(vocabulary.fields, ['user', 'item'])
+                # user: a=0 b=1 c=2 oov=3 (d) / item: x=4 y=5 oov=6 (z)
+                self.assertEqual(vocabulary.num_feature, 7)
+                self.assertTrue((train.target_value == [5, 3, 1, 2] * 3 + [4]).all())
+                self.assertTrue((train.data.col == [0, 4, 1, 4, 0, 5, 2] * 3 + [3, 6]).all())
+                self.assertTrue((train.data.row == np.repeat(np.arange(13), [2, 2, 2, 1] * 3 + [2])).all())
+                self.assertTrue((test.data.col == [0, 6, 3, 5]).all())
+                self.assertEqual(train.num_feature, test.num_feature)
+                
+                meta = vocabulary.meta_info()
+                self.assertEqual(meta.num_attr_groups, 2)
+                self.assertTrue((meta.attr_group == [0, 0, 0, 0, 1, 1, 1]).all())
+                self.assertTrue((meta.num_attr_per_group == [4, 3]).all())
+            
+            vocabulary = CategoricalVocabulary(target_column=1, delimiter=';', has_header=True, min_count=2, oov='drop')
+            train = Data.from_categorical(train_file, vocabulary, False, True, role='train')
+            self.assertEqual(vocabulary.num_feature, 5)
+            self.assertTrue((train.data.col[-3:] == [0, 4, 2]).all()) # the last line (d, z) has no feature
+            self.assertEqual(train.X.indptr[-1], train.X.indptr[-2])
+        finally:
+            shutil.rmtree(tmp_dir)
+    
+    def test_cache(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmp_dir, 'train.libfm')
+            shutil.copy('data/small_train.libfm', filename)
+            ref = Data(filename, False, True, 12)
+            train = Data(filename, False, True, 12, cache=True)
+            self.assertTrue(is_libfm_cache_valid(filename))
+            train = Data(filename, False, True, 12, cache=True)
+            self.assertFalse(train.data_t.data.flags.writeable) # read-only memory map
+            self.assertEqual((train.num_cases, train.num_feature, train.min_target, train.max_target),
+                             (ref.num_cases, ref.num_feature, ref.min_target, ref.max_target))
+            self.assertTrue((train.data.row == ref.data.row).all() and (train.data.col == ref.data.col).all())
+            self.assertTrue((train.target_value == ref.target_value).all())
+            self.assertTrue((train.x_rows_sqr == ref.x_rows_sqr).all())
+            self.assertTrue((train.row_start_stop == ref.row_start_stop).all())
+            self.assertTrue(((train.tmp - ref.tmp) != 0).nnz == 0 and train.tmp.shape == ref.tmp.shape)
+            
+            # a modified source file makes the cache stale and it is rebuilt
+            with open(filename, 'a') as f:
+                f.write('3 11:1\n')
+            self.assertFalse(is_libfm_cache_valid(filename))
+            train = Data(filename, False, True, cache=True)
+            self.assertEqual((train.num_cases, train.num_feature), (16, 12))
+            self.assertTrue(is_libfm_cache_valid(filename))
+            
+            # the cache is rebuilt with the layout of the values
+            self.assertFalse(is_libfm_cache_valid(filename, implicit_ones=True))
+            train = Data(filename, False, True, cache=True, implicit_ones=True)
+            self.assertTrue(is_libfm_cache_valid(filename, implicit_ones=True))
+            self.assertFalse(os.path.exists(os.path.join(filename + '.cache', 't_data.npy')))
+            self.assertTrue((train.dot_t(np.arange(12.)) == ref.dot_t(np.arange(12.))[:15].tolist() + [11]).all())
+        finally:
+            shutil.rmtree(tmp_dir)
+    
+    def test_meta_groups(self):
+        fd, filename = tempfile.mkstemp(suffix='.meta')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write('0\n0\n1\n1\n1\n2\n2\n2\n0\n')
+            meta = load_meta_info(filename, 9)
+            self.assertEqual(meta.num_attr_groups, 3)
+            self.assertTrue((meta.num_attr_per_group == [3, 3, 3]).all())
+            self.assertRaises(ValueError, load_meta_info, filename, 10)
+        finally:
+            os.remove(filename)
+        
+        # the vectorized hyperpriors match the per group means
+        init = Initialisation()
+        fm = libFM(init.num_all_attribute, seed=3, method='mcmc', dim='1,1,2', init_stdev=0.1)
+        fm.do_sample = False
+        mcmc = MCMC_learn(fm, meta, init.train, init.test, 0)
+        mcmc.draw_w_lambda()
+        mcmc.draw_w_mu()
+        mcmc.draw_v_lambda()
+        mcmc.draw_v_mu()
+        for g in xrange(3):
+            attr = meta.attr_group == g
+            w_mu = (fm.w[attr].sum() + mcmc.beta_0 * mcmc.mu_0) / (attr.sum() + mcmc.beta_0)
+            v_mu = (fm.v[:, attr].sum(axis=1) + mcmc.beta_0 * mcmc.mu_0) / (attr.sum() + mcmc.beta_0)
+            self.assertAlmostEqual(mcmc.w_mu[g], w_mu)
+            np.testing.assert_array_almost_equal(mcmc.v_mu[g], v_mu)
+    
+    def test_relation(self):
+        # the user block of each case is stored once per user (libFM BS format)
+        rng = np.random.RandomState(0)
+        num_cases, num_users = 40, 5
+        target = rng.randint(1, 6, num_cases).astype(float)
+        items = rng.randint(0, 4, num_cases)
+        X_main = sps.csr_matrix((np.ones(num_cases), items, np.arange(num_cases + 1)), shape=(num_cases, 4))
+        X_block = sps.csr_matrix(rng.randint(0, 3, (num_users, 3)) + 0.5)
+        index = rng.randint(0, num_users, num_cases)
+        flat = sps.hstack([X_main, X_block[index]]).tocsr()
+        
+        block = Data.from_csr(np.zeros(num_users), X_block, False, True, role='train')
+        train = Data.from_csr(target, X_main, False, True, role='train')
+        test = Data.from_csr(target, X_main, True, False, role='eval')
+        train.add_relation(block, index)
+        test.add_relation(block, index)
+        self.assertEqual(train.num_all_feature, 7)
+        np.testing.assert_array_almost_equal(train.dot_t(np.arange(7.)), flat.dot(np.arange(7.)))
+        np.testing.assert_array_almost_equal(test.dot_t_sqr(np.arange(7.)), flat.multiply(flat).dot(np.arange(7.)))
+        self.assertRaises(ValueError, train.add_relation, block, index[1:])
+        
+        pred = []
+        for train, test in [(train, test), (Data.from_csr(target, flat, False, True, role='train'), 
+                                            Data.from_csr(target, flat, True, False, role='eval'))]:
+            fm = libFM(7, seed=3, method='als', num_iter=5, dim='1,1,2', init_stdev=0.1)
+            fm.save = False
+            mcmc = MCMC_learn(fm, DataMetaInfo(7), train, test, 0)
+            mcmc.learn()
+            pred.append((mcmc.predict(), fm.w, fm.v))
+        for rel, ref in zip(*pred):
+            np.testing.assert_array_almost_equal(rel, ref)
+    
+    def test_colored(self):
+        # user, item and context one-hot fields and a real valued feature
+        rng = np.random.RandomState(1)
+        num_cases = 60
+        fields = [np.arange(num_cases) % 5, 5 + rng.permutation(np.arange(num_cases) % 4), 
+                  9 + rng.randint(0, 3, num_cases)]
+        rows = np.repeat(np.arange(num_cases), 4)
+        cols = np.vstack(fields + [np.repeat(12, num_cases)]).T.ravel()
+        values = np.vstack([np.ones((3, num_cases)), rng.rand(num_cases)]).T.ravel()
+        X = sps.csr_matrix((values, (rows, cols)), shape=(num_cases, 13))
+        target = rng.randint(1, 6, num_cases).astype(float)
+        
+        train = Data.from_csr(target, X, False, True, role='train')
+        order, color_ptr = train.color_classes
+        self.assertEqual(sorted(order), range(13))
+        for color in xrange(color_ptr.shape[0] - 1):
+            features = X[:, order[color_ptr[color]:color_ptr[color + 1]]]
+            self.assertTrue((features.getnnz(axis=1) <= 1).all()) # no shared case
+        
+        # the colored sweeps are the sequential sweeps of the features ordered by color
+        fm = libFM(13, seed=3, method='als', num_iter=5, dim='1,1,2', init_stdev=0.1)
+        fm_seq = libFM(13, seed=3, method='als', num_iter=5, dim='1,1,2', init_stdev=0.1)
+        fm_seq.w, fm_seq.v = fm.w[order], fm.v[:, order]
+        X_seq = X[:, order]
+        pred = []
+        for model, train, test, colored in [(fm, train, Data.from_csr(target, X, True, False, role='eval'), True),
+                                            (fm_seq, Data.from_csr(target, X_seq, False, True, role='train'), 
+                                             Data.from_csr(target, X_seq, True, False, role='eval'), False)]:
+            model.save = False
+            mcmc = MCMC_learn(model, DataMetaInfo(13), train, test, 0, colored=colored)
+            mcmc.learn()
+            pred.append(mcmc.predict())
+        np.testing.assert_array_almost_equal(pred[0], pred[1])
+        np.testing.assert_array_almost_equal(fm.w[order], fm_seq.w)
+        np.testing.assert_array_almost_equal(fm.v[:, order], fm_seq.v)
+        
+        # the parallel blocks give the same draws for any number of threads
+        models = []
+        num_active_threads = threading.active_count()
+        for num_threads in [1, 3]:
+            model = libFM(13, seed=5, method='mcmc', num_iter=5, dim='1,1,2', init_stdev=0.1)
+            model.save = False
+            mcmc = MCMC_learn(model, DataMetaInfo(13), train, test, 0, colored=True, num_threads=num_threads)
+            mcmc.learn()
+            models.append(model)
+        self.assertTrue((models[0].w == models[1].w).all() and (models[0].v == models[1].v).all())
+        self.assertEqual(threading.active_count(), num_active_threads) # learn stops the threads of its pool
+    
+    def test_q_cache(self):
+        init = Initialisation()
+        train, test, num_all_attribute = init.train, init.test, init.num_all_attribute
+        pred = []
+        for q_cache, q_cache_limit in [(False, None), (True, None), (True, 8 * train.num_cases)]:
+            fm = libFM(num_all_attribute, seed=3, method='mcmc', num_iter=10, dim='1,1,2', init_stdev=0.1)
+            fm.save = False
+            mcmc = MCMC_learn(fm, DataMetaInfo(num_all_attribute), train, test, 0, 
+                              q_cache=q_cache, q_cache_limit=q_cache_limit)
+            mcmc.learn()
+            pred.append(mcmc.predict())
+            if q_cache:
+                # the cache is the q-terms of the last draws
+                self.assertEqual(mcmc.q.shape[0], 2 if q_cache_limit is None else 1)
+                for f in xrange(mcmc.q.shape[0]):
+                    np.testing.assert_array_almost_equal(mcmc.q[f], train.dot_t(fm.v[f]))
+        np.testing.assert_array_almost_equal(pred[0], pred[1])
+        np.testing.assert_array_almost_equal(pred[0], pred[2])
+    
+    def test_incremental_eterms(self):
+        init = Initialisation()
+        train, test, num_all_attribute = init.train, init.test, init.num_all_attribute
+        fm = libFM(num_all_attribute, seed=3, method='mcmc', num_iter=10, dim='1,1,2', init_stdev=0.1)
+        fm.save = False
+        mcmc = MCMC_learn(fm, DataMetaInfo(num_all_attribute), train, test, 0, colored=True)
+        mcmc.learn()
+        
+        # the e-terms kept up to date by the draws are the recomputed ones
+        e = np.copy(mcmc.cache[0])
+        mcmc.predict_data_and_write_to_eterms()
+        np.testing.assert_array_almost_equal(e, mcmc.cache[0] - train.target_value)
+        
+        # the test prediction with a single product for all the factors
+        pred = fm.w0 + test.dot_t(fm.w)
+        for f in xrange(fm.num_factor):
+            pred += 0.5 * (test.dot_t(fm.v[f])**2 - test.dot_t_sqr(fm.v[f]**2))
+        np.testing.assert_array_almost_equal(mcmc.predict_test(), pred)
+        data = RandomRegression(50, 10)
+        X_sqr = data.test._X_sqr
+        np.testing.assert_array_almost_equal(data.test.dot_t_sqr(np.arange(10.)), data.X.multiply(data.X).dot(np.arange(10.)))
+        self.assertTrue(X_sqr is None and data.test._X_sqr is not None)
+        X_sqr = data.test._X_sqr
+        data.test.dot_t_sqr(np.ones((2, 10)))
+        self.assertTrue(data.test._X_sqr is X_sqr) # built once
+        implicit = Data.from_csr(test.target_value, test.X, True, False, implicit_ones=True)
+        np.testing.assert_array_almost_equal(implicit.dot_t(fm.v), [implicit.dot_t(v) for v in fm.v])
+    
+    def test_joint(self):
+        rng = np.random.RandomState(2)
+        X = sps.csr_matrix(rng.rand(50, 10) * (rng.rand(50, 10) < 0.4))
+        target = rng.randint(1, 6, 50).astype(float)
+        train = Data.from_csr(target, X, False, True, role='train')
+        test = Data.from_csr(target, X, True, False, role='eval')
+        
+        # block ALS: each draw minimizes the squared error, which can only decrease
+        fm = libFM(10, seed=3, method='als', num_iter=1, dim='1,1,3', init_stdev=0.1)
+        mcmc = MCMC_learn(fm, DataMetaInfo(10), train, test, 0, joint=True, q_cache=True)
+        mcmc.predict_data_and_write_to_eterms()
+        mcmc.cache[0] -= target
+        errors = []
+        for i in xrange(10):
+            mcmc.draw_all()
+            errors.append(np.sum(mcmc.cache[0] ** 2))
+        self.assertTrue((np.diff(errors) <= 1e-9).all())
+        np.testing.assert_array_almost_equal(mcmc.q, train.dot_t(fm.v))
+        e = np.copy(mcmc.cache[0])
+        mcmc.predict_data_and_write_to_eterms()
+        np.testing.assert_array_almost_equal(e, mcmc.cache[0] - target)
+        
+        # the conditional of draw_v: same ALS fit for a single factor
+        models = []
+        for joint in [False, True]:
+            model = libFM(10, seed=3, method='als', num_iter=5, dim='1,1,1', init_stdev=0.1)
+            model.save = False
+            MCMC_learn(model, DataMetaInfo(10), train, test, 0, joint=joint).learn()
+            models.append(model)
+        np.testing.assert_array_almost_equal(models[0].v, models[1].v)
+        
+        # block Gibbs, with the same draws for any number of threads
+        models = []
+        for num_threads in [1, 2]:
+            model = libFM(10, seed=5, method='mcmc', num_iter=5, dim='1,1,3', init_stdev=0.1)
+            model.save = False
+            MCMC_learn(model, DataMetaInfo(10), train, test, 0, joint=True, num_threads=num_threads).learn()
+            models.append(model)
+        self.assertTrue(np.isfinite(models[0].v).all())
+        np.testing.assert_array_almost_equal(models[0].v, models[1].v)
+        
+        # the features with more than 5 (20) values are drawn alone, by slices of 15 (60) values
+        chunk_size = libfm_sparse_v2.JOINT_CHUNK_SIZE
+        for size in [45, 180]:
+            libfm_sparse_v2.JOINT_CHUNK_SIZE = size
+            try:
+                model = libFM(10, seed=5, method='mcmc', num_iter=5, dim='1,1,3', init_stdev=0.1)
+                model.save = False
+                MCMC_learn(model, DataMetaInfo(10), train, test, 0, joint=True).learn()
+            finally:
+                libfm_sparse_v2.JOINT_CHUNK_SIZE = chunk_size
+            np.testing.assert_array_almost_equal(model.v, models[0].v)
+        
+        # a feature in less than k cases (10) or alone in its case (11) has a singular
+        # precision, its factors are drawn one after the other as in draw_v
+        X = np.hstack((X.toarray(), np.zeros((50, 2))))
+        X[3, 10] = 1
+        X[7, :] = 0
+        X[7, 11] = 1
+        X = sps.csr_matrix(X)
+        train = Data.from_csr(target, X, False, True, role='train')
+        test = Data.from_csr(target, X, True, False, role='eval')
+        model = libFM(12, seed=5, method='mcmc', num_iter=5, dim='1,1,3', init_stdev=0.1)
+        model.save = False
+        v_init = np.copy(model.v)
+        mcmc = MCMC_learn(model, DataMetaInfo(12), train, test, 0, joint=True)
+        mcmc.learn()
+        self.assertTrue((model.v[:, 11] == v_init[:, 11]).all())
+        self.assertTrue(np.abs(model.v[:, 10]).max() < 1e3)
+        
+        mcmc.predict_data_and_write_to_eterms()
+        mcmc.cache[0] -= target
+        q, noise = train.dot_t(model.v), np.array([[0.5], [-1], [2]])
+        v, e = np.copy(model.v), np.copy(mcmc.cache[0])
+        mcmc.draw_v_joint(np.array([10]), noise, q)
+        v_joint, e_joint, q_joint = np.copy(model.v), np.copy(mcmc.cache[0]), np.copy(q)
+        model.v[:], mcmc.cache[0], q = v, e, train.dot_t(v)
+        mcmc.draw_v_factors(10, noise[:, 0], q)
+        np.testing.assert_array_almost_equal(model.v, v_joint)
+        np.testing.assert_array_almost_equal(mcmc.cache[0], e_joint)
+        np.testing.assert_array_almost_equal(q, q_joint)
+        self.assertTrue((model.v[:, 10] != v[:, 10]).all())
+    
+    def test_random_streams(self):
+        init = Initialisation()
+        train, test, num_all_attribute = init.train, init.test, init.num_all_attribute
+        models = []
+        for i in xrange(2):
+            fm = libFM(num_all_attribute, seed=7, method='mcmc', num_iter=5, dim='1,1,2', init_stdev=0.1)
+            fm.save = False
+            np.random.rand(i) # the draws do not use the global state
+            state = np.random.get_state()[1]
+            mcmc = MCMC_learn(fm, DataMetaInfo(num_all_attribute), train, test, 0)
+            mcmc.learn()
+            self.assertTrue((np.random.get_state()[1] == state).all())
+            models.append(fm)
+        self.assertTrue((models[0].w == models[1].w).all() and (models[0].v == models[1].v).all())
+        
+        # the streams are keyed by the iteration and the sweep
+        self.assertEqual(mcmc.iteration, 5)
+        self.assertEqual(mcmc.sweep_noise(3, 2, 1).tolist(), mcmc.substream(2, 1).standard_normal(3).tolist())
+        self.assertNotEqual(mcmc.sweep_noise(3, 2, 1).tolist(), mcmc.sweep_noise(3, 2, 0).tolist())
+    
+    def test_kernels(self):
+        # the kernels give the draws of the numpy reference
+        init = Initialisation()
+        train, test, num_all_attribute = init.train, init.test, init.num_all_attribute
+        backends = ['numpy', 'python'] + (['numba'] if numba is not None else [])
+        for method in ['als', 'mcmc']:
+            models = []
+            for backend in backends:
+                # sequential, colored and on threads
+                for num_threads, colored in [(1, False), (1, True), (2, True)]:
+                    fm = libFM(num_all_attribute, seed=3, method=method, num_iter=5, dim='1,1,2', init_stdev=0.1)
+                    fm.save = False
+                    mcmc = MCMC_learn(fm, DataMetaInfo(num_all_attribute), train, test, 0, backend=backend,
+                                      colored=colored, num_threads=num_threads)
+                    mcmc.learn()
+                    models.append((mcmc.predict(), fm.w, fm.v, mcmc.cache[0]))
+            for model in models[1:]:
+                for array, ref in zip(model, models[0]):
+                    np.testing.assert_array_almost_equal(array, ref)
+        self.assertRaises(Exception, get_kernels, 'cuda')
+        for option in ['jacobi', 'joint']:
+            self.assertRaises(Exception, MCMC_learn, libFM(num_all_attribute, method='als'), 
+                              DataMetaInfo(num_all_attribute), train, test, 0, backend='python', **{option: True})
+    
+    def test_float32(self):
+        for method in ['als', 'mcmc']:
+            rmse = []
+            for dtype in [np.float64, np.float32]:
+                data = RandomRegression(200, 30, dtype)
+                train, test, target = data.train, data.test, data.target
+                fm = libFM(30, seed=3, method=method, num_iter=10, dim='1,1,4', init_stdev=0.1, dtype=dtype)
+                fm.save = False
+                mcmc = MCMC_learn(fm, DataMetaInfo(30), train, test, 0, colored=True)
+                mcmc.learn()
+                self.assertEqual((fm.w.dtype, fm.v.dtype, mcmc.cache.dtype), (dtype,) * 3)
+                self.assertEqual(mcmc.posterior.mean.dtype, np.float64)
+                rmse.append(mcmc.evaluate(mcmc.predict(), target, 1.0, 0, 200)[0])
+            self.assertLess(abs(rmse[0] - rmse[1]), 1e-3)
+        # the q cache limit counts 4 bytes per float32 value
+        for dtype, num_q_cached in [(np.float64, 2), (np.float32, 4)]:
+            fm = libFM(30, seed=3, method='als', num_iter=1, dim='1,1,4', init_stdev=0.1, dtype=dtype)
+            mcmc = MCMC_learn(fm, DataMetaInfo(30), train, test, 0, q_cache=True, q_cache_limit=16 * 200)
+            self.assertEqual(mcmc.num_q_cached, num_q_cached)
+    
+    def test_jacobi(self):
+        data = RandomRegression(200, 30)
+        train, test, target = data.train, data.test, data.target
+        
+        fallbacks = []
+        for damping in [0.5, 2.0]:
+            fm = libFM(30, seed=3, method='als', num_iter=1, dim='1,1,4', init_stdev=0.1)
+            mcmc = MCMC_learn(fm, DataMetaInfo(30), train, test, 0, jacobi=True, damping=damping)
+            mcmc.predict_data_and_write_to_eterms()
+            mcmc.cache[0] -= target
+            errors = []
+            for i in xrange(20):
+                mcmc.draw_all()
+                errors.append(np.sum(mcmc.cache[0] ** 2))
+            self.assertTrue((np.diff(errors) <= 1e-9).all())
+            self.assertLess(errors[-1], 0.1 * errors[0])
+            e = np.copy(mcmc.cache[0])
+            mcmc.predict_data_and_write_to_eterms()
+            np.testing.assert_array_almost_equal(e, mcmc.cache[0] - target)
+            fallbacks.append(mcmc.num_jacobi_fallbacks)
+        # the overshooting updates fall back to the sequential ones more often
+        self.assertLess(fallbacks[0], fallbacks[1])
+        self.assertRaises(Exception, MCMC_learn, libFM(30, method='mcmc'), DataMetaInfo(30), train, test, 0, jacobi=True)
+    
+    def test_active_set(self):
+        data = RandomRegression(200, 30)
+        train, test, target = data.train, data.test, data.target
+        
+        errors, swept = [], []
+        for active_set, colored in [(False, False), (True, False), (True, True)]:
+            fm = libFM(30, seed=3, method='als', num_iter=1, dim='1,1,2', init_stdev=0.1)
+            mcmc = MCMC_learn(fm, DataMetaInfo(30), train, test, 0, colored=colored,
+                              active_set=active_set, active_tol=1e-4, full_sweep=10)
+            mcmc.predict_data_and_write_to_eterms()
+            mcmc.cache[0] -= target
+            for i in xrange(40):
+                if active_set and i == 35:
+                    swept.append(mcmc.w_active.rows(mcmc.iteration).shape[0])
+                mcmc.draw_all()
+            errors.append(np.sum(mcmc.cache[0] ** 2))
+            e = np.copy(mcmc.cache[0])
+            mcmc.predict_data_and_write_to_eterms()
+            np.testing.assert_array_almost_equal(e, mcmc.cache[0] - target)
+        # close to the full sweeps while skipping features late in the run
+        self.assertLess(errors[1], 1.01 * errors[0])
+        self.assertLess(errors[2], 1.01 * errors[0])
+        self.assertLess(max(swept), 30)
+        self.assertRaises(Exception, MCMC_learn, libFM(30, method='mcmc'), DataMetaInfo(30), train, test, 0, active_set=True)
+    
     def test_w0_ALS(self):
         init = Initialisation()
         train, test, num_all_attribute = init.train, init.test, init.num_all_attribute
@@ -65,6 +756,174 @@ class DataTests(unittest.TestCase):
         mcmc.learn()
         np.testing.assert_array_almost_equal(mcmc.predict(), [ 3.266, 3.266, 3.266, 3.266], decimal=1, err_msg='', verbose=True)
     
+    def test_eval_every(self):
+        data = RandomRegression(200, 30)
+        train, test, target = data.train, data.test, data.target
+        
+        for eval_every, iterations in [(3, [2, 5, 8, 9]), (0, [9])]:
+            fm = libFM(30, seed=3, method='als', num_iter=10, dim='1,1,2', init_stdev=0.1)
+            fm.save = False
+            mcmc = MCMC_learn(fm, DataMetaInfo(30), train, test, 0, eval_every=eval_every)
+            predict_test, calls = mcmc.predict_test, []
+            mcmc.predict_test = lambda: calls.append(1) or predict_test()
+            mcmc.learn()
+            # ALS predicts the test cases only when evaluating
+            self.assertEqual([h[0] for h in mcmc.history], iterations)
+            self.assertEqual(len(calls), len(iterations))
+            rmse, mae = mcmc.evaluate(mcmc.predict(), target, 1.0, 0, 200)
+            self.assertAlmostEqual(mcmc.history[-1][2], rmse)
+            self.assertAlmostEqual(mcmc.history[-1][3], mae)
+        
+        fm = libFM(30, seed=3, method='mcmc', num_iter=5, dim='1,1,2', init_stdev=0.1)
+        fm.save = False
+        mcmc = MCMC_learn(fm, DataMetaInfo(30), train, test, 0, eval_sample=50)
+        mcmc.learn()
+        rows = mcmc.eval_rows[1]
+        self.assertEqual(rows.shape[0], 50)
+        rmse, mae = mcmc.evaluate(mcmc.predict()[rows], target[rows], 1.0, 0, 50)
+        self.assertAlmostEqual(mcmc.history[-1][2], rmse)
+        self.assertAlmostEqual(mcmc.history[-1][3], mae)
+        rmse_train, _ = mcmc.evaluate(mcmc.cache[0] + target, target, 1.0, 0, 200)
+        self.assertNotEqual(mcmc.history[-1][1], rmse_train)
+    
+    def test_early_stopping(self):
+        data = RandomRegression(200, 30)
+        train, test, target = data.train, data.test, data.target
+        
+        fm = libFM(30, seed=3, method='als', num_iter=200, dim='1,1,2', init_stdev=0.1)
+        fm.save = False
+        mcmc = MCMC_learn(fm, DataMetaInfo(30), train, test, 0, tol=1e-3, patience=3)
+        mcmc.learn()
+        self.assertEqual(mcmc.stop_reason, 'converged')
+        self.assertLess(mcmc.num_iter_done, 200)
+        rmse = np.array([h[2] for h in mcmc.history[-4:]])
+        self.assertTrue((np.abs(np.diff(rmse)) < 1e-3 * rmse[:-1]).all())
+        
+        fm = libFM(30, seed=3, method='mcmc', num_iter=1000, dim='1,1,2', init_stdev=0.1)
+        fm.save = False
+        mcmc = MCMC_learn(fm, DataMetaInfo(30), train, test, 2, time_budget=0.0)
+        mcmc.learn()
+        # burn-in is not over, no sample to predict from
+        self.assertEqual((mcmc.stop_reason, mcmc.num_iter_done), ('time_budget', 1))
+        self.assertRaises(Exception, mcmc.predict)
+        
+        mcmc = MCMC_learn(fm, DataMetaInfo(30), train, test, 0, tol=1e-3, patience=2, eval_every=5, thin=2)
+        mcmc.learn()
+        self.assertEqual(mcmc.stop_reason, 'converged')
+        self.assertEqual(mcmc.posterior.num_samples, (mcmc.num_iter_done + 1) // 2)
+    
+    def test_chains(self):
+        data = RandomRegression(200, 30)
+        train, test, target = data.train, data.test, data.target
+        fm_kwargs = dict(num_iter=12, dim='1,1,2', init_stdev=0.1)
+        
+        pred, r_hat, chains = run_chains(DataMetaInfo(30), train, test, 4, 3, num_workers=2, seed=5, 
+                                         fm_kwargs=fm_kwargs, colored=True)
+        self.assertEqual(len(chains), 3)
+        # each chain is the one run alone with its seed
+        fm = libFM(30, seed=6, method='mcmc', **fm_kwargs)
+        fm.save = False
+        mcmc = MCMC_learn(fm, DataMetaInfo(30), train, test, 4, colored=True)
+        mcmc.learn()
+        np.testing.assert_array_almost_equal(chains[1][0].mean, mcmc.predict())
+        np.testing.assert_array_almost_equal(pred, np.mean([chain[0].mean for chain in chains], axis=0))
+        self.assertEqual(r_hat.shape, (200,))
+        self.assertTrue((r_hat >= 0.5).all() and np.median(r_hat) < 2)
+        
+        # in process, the same chains
+        same, same_r_hat, same_chains = run_chains(DataMetaInfo(30), train, test, 4, 3, seed=5, 
+                                                   fm_kwargs=fm_kwargs, colored=True)
+        np.testing.assert_array_almost_equal(same, pred)
+        np.testing.assert_array_almost_equal(same_r_hat, r_hat)
+    
+    def test_consensus(self):
+        data = RandomRegression(400, 30)
+        train, test, target = data.train, data.test, data.target
+        fm_kwargs = dict(num_iter=20, dim='1,1,2', init_stdev=0.1)
+        
+        pred, draws = run_consensus(train, test, 2, 5, seed=3, fm_kwargs=fm_kwargs)
+        w0, w, v = draws
+        self.assertEqual((w0.shape, w.shape, v.shape), ((15,), (15, 30), (15, 2, 30)))
+        fm = libFM(30, seed=3, method='mcmc', **fm_kwargs)
+        fm.save = False
+        mcmc = MCMC_learn(fm, DataMetaInfo(30), train, test, 5)
+        mcmc.learn()
+        rmse = mcmc.evaluate(pred, target, 1.0, 0, 400)[0]
+        self.assertLess(rmse, 2 * mcmc.evaluate(mcmc.predict(), target, 1.0, 0, 400)[0])
+        
+        # the shards start from the same model (seed) but draw from their own streams
+        shard = dict(seed=3, num_attribute=30, target=target, X=data.X, burn=0, 
+                     fm_kwargs=dict(fm_kwargs, num_iter=2), mcmc_kwargs={})
+        samples = [libfm_sparse_v2.sample_shard(i, **shard) for i in [0, 0, 1]]
+        for a, b in zip(samples[0], samples[1]):
+            np.testing.assert_array_equal(a, b)
+        for a, b in zip(samples[0], samples[2]):
+            self.assertTrue((a != b).all())
+        
+        # the shards do not count the prior num_shards times: the joint draws do not use it
+        models = []
+        for scale in [1.0, 100.0]:
+            fm = libFM(30, seed=3, method='mcmc', num_iter=1, dim='1,1,2', init_stdev=0.1)
+            mcmc = MCMC_learn(fm, DataMetaInfo(30), train, test, 0, joint=True)
+            mcmc.predict_data_and_write_to_eterms()
+            mcmc.cache[0] -= target
+            mcmc.draw_v_lambda = lambda: None
+            mcmc.draw_v_mu = lambda: None
+            mcmc.v_lambda[:] = scale
+            mcmc.v_mu[:] = scale
+            mcmc.draw_all()
+            models.append(fm)
+        np.testing.assert_array_almost_equal(models[0].v, models[1].v)
+        
+        # precision weighted average of the shards, the features of no shard are 0
+        rng = np.random.RandomState(5)
+        shards = [dict(w0=rng.randn(10), w=s * rng.randn(10, 3), v=None) for s in [1.0, 2.0]]
+        present = [np.array([True, True, False]), np.array([True, False, False])]
+        w0, w, v = consensus_draws(shards, present)
+        precision = [1 / np.var(shard['w'][:, 0]) for shard in shards]
+        np.testing.assert_array_almost_equal(w[:, 0], np.dot(precision, [shard['w'][:, 0] for shard in shards]) / sum(precision))
+        np.testing.assert_array_almost_equal(w[:, 1], shards[0]['w'][:, 1])
+        np.testing.assert_array_equal(w[:, 2], 0)
+        self.assertEqual(v, [None] * 10)
+        
+        # no default secret: remote workers or a public address need one
+        environ = dict(os.environ)
+        os.environ.pop('LIBFM_SHARD_AUTHKEY', None)
+        try:
+            self.assertRaises(Exception, run_consensus, train, test, 2, 5, local_workers=False)
+            self.assertRaises(Exception, run_consensus, train, test, 2, 5, address=('0.0.0.0', 0))
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+    
+    def test_burn_thin(self):
+        init = Initialisation()
+        train, test, num_all_attribute = init.train, init.test, init.num_all_attribute
+        fm = libFM(num_all_attribute, seed=3, method='mcmc', num_iter=10, dim='1,1,2', init_stdev=0.1)
+        fm.save = False
+        mcmc = MCMC_learn(fm, DataMetaInfo(num_all_attribute), train, test, 4, thin=3, pred_var=True)
+        predict_test, preds = mcmc.predict_test, []
+        def record():
+            preds.append(np.clip(predict_test(), mcmc.min_target, mcmc.max_target))
+            return preds[-1]
+        mcmc.predict_test = record
+        mcmc.learn()
+        # the samples 4 and 7 only are predicted
+        self.assertEqual(len(preds), 2)
+        np.testing.assert_array_almost_equal(mcmc.predict(), np.mean(preds, axis=0))
+        np.testing.assert_array_almost_equal(mcmc.posterior.var(), np.var(preds, axis=0))
+        
+        mcmc = MCMC_learn(fm, DataMetaInfo(num_all_attribute), train, test, 10)
+        mcmc.learn()
+        self.assertRaises(Exception, mcmc.predict)
+        
+        x = np.random.RandomState(0).randn(50, 7)
+        mean = RunningMean(7, variance=True)
+        for row in x:
+            mean.add(row)
+        np.testing.assert_array_almost_equal(mean.mean, x.mean(axis=0))
+        np.testing.assert_array_almost_equal(mean.var(), x.var(axis=0))
+    
     def test_w_ALS(self): 
         init = Initialisation()
         train, test, num_all_attribute = init.train, init.test, init.num_all_attribute